@@ -2,145 +2,213 @@ import numpy as np
 import pandas as pd
 import os
 
-def abundance(name, r, HIIREGID, EWHa, Hb4861, eHb4861, Ha6562, eHa6562, 
-              OIII5006, eOIII5006, NII6583, eNII6583, SII6716, eSII6716, SII6730, eSII6730, calibrator):
+CALIBRATORS = {1: 'PP04_O3N2', 2: 'PP04_N2', 3: 'M13_O3N2', 4: 'M13_N2', 5: 'D16'}
+
+# --- Extinction factor (Cavichia et al. 2010)
+def extinction(x):
+    return (0.00001 + 0.22707/x + 1.95243/x**2 - 2.67596/x**3 +
+            2.6507/x**4 - 1.26812/x**5 + 0.27549/x**6 - 0.02212/x**7)
+
+# --- Extinction coefficients of the lines (wavelengths in microns), computed once
+AV = {'Hb4861': extinction(4861.32e-4),
+      'Ha6562': extinction(6562.68e-4),
+      'OIII5006': extinction(5006.84e-4),
+      'NII6583': extinction(6583.41e-4),
+      'SII6716': extinction(6716.39e-4),
+      'SII6730': extinction(6730.74e-4)}
+
+# --- Columns of tables/<name>.csv computed from the fluxes
+TABLE_COLUMNS = ['Ha6562_cor', 'eHa6562_cor', 'OIII5006_cor', 'eOIII5006_cor', 'NII6583_cor', 'eNII6583_cor',
+                 'SII6716_cor', 'eSII6716_cor', 'SII6730_cor', 'eSII6730_cor',
+                 'OH_PP04_O3N2', 'eOH_PP04_O3N2', 'OH_PP04_N2', 'eOH_PP04_N2', 'OH_M13_O3N2', 'eOH_M13_O3N2',
+                 'OH_M13_N2', 'eOH_M13_N2', 'OH_D16', 'eOH_D16']
+
+
+def abundance_kernel(flux, calibrators=None, galaxy=None, dtype=np.float64, lines=()):
     """
-    Calculates abundances using the PP04, M13 and D16 calibrators from extinction-corrected fluxes. Works with arrays or pandas.Series.
+    Extinction correction, O3N2/N2 indices, calibrators, errors and quality masks in one NumPy pass over a stacked
+    table of HII regions from any number of galaxies. flux maps the flux_elines column names (fluxHb4861,
+    e_fluxHb4861, ...) to arrays; galaxy is an optional galaxy index per region, passed through.
+    Only what the requested calibrators (default: all) need is computed, e.g. the SII lines only for D16; lines
+    names extra lines to correct anyway (e.g. 'OIII5006' for the BPT criteria).
+    Returns a dict of arrays: the columns of tables/<name>.csv, O3N2_index, N2_index (and errors) and
+    mask_<calibrator name>.
     """
 
-    # --- Extinction factor (Cavichia et al. 2010)
-    def extinction(x):
-        return (0.00001 + 0.22707/x + 1.95243/x**2 - 2.67596/x**3 +
-                2.6507/x**4 - 1.26812/x**5 + 0.27549/x**6 - 0.02212/x**7)
-    
-    av_Hb4861 = extinction(4861.32e-4)
-    av_Ha6562 = extinction(6562.68e-4)
-    av_OIII5006 = extinction(5006.84e-4)
-    av_NII6583 = extinction(6583.41e-4)
-    av_SII6716 = extinction(6716.39e-4)
-    av_SII6730 = extinction(6730.74e-4)
-
-    # --- Color excess (Cavichia 2008)
-    excess = (np.log10(2.86) - np.log10(Ha6562/Hb4861)) / (0.4 * (av_Ha6562 - av_Hb4861))
-
-    # --- Extinction correction and error propagation
-    def flux_cor(flux_line, e_flux_line, flux_Hb, e_flux_Hb, av_line, av_Hb, excess):
-        flux_corr = np.log10(flux_line / flux_Hb) + 0.4 * excess     * (av_line - av_Hb)
-        e_flux_corr = (1/np.log(10)) * np.sqrt((e_flux_line/flux_line)**2 + (e_flux_Hb/flux_Hb)**2)
-        return flux_corr, e_flux_corr
-
-    Ha6562_cor, eHa6562_cor = flux_cor(Ha6562, eHa6562, Hb4861, eHb4861, av_Ha6562, av_Hb4861, excess)
-    OIII5006_cor, eOIII5006_cor = flux_cor(OIII5006, eOIII5006, Hb4861, eHb4861, av_OIII5006, av_Hb4861, excess)
-    NII6583_cor, eNII6583_cor = flux_cor(NII6583, eNII6583, Hb4861, eHb4861, av_NII6583, av_Hb4861, excess)
-    SII6716_cor, eSII6716_cor = flux_cor(SII6716, eSII6716, Hb4861, eHb4861, av_SII6716, av_Hb4861, excess)
-    SII6730_cor, eSII6730_cor = flux_cor(SII6730, eSII6730, Hb4861, eHb4861, av_SII6730, av_Hb4861, excess)
-
-    # --- Index
-    # --- O3N2 (Alloin et al. 1979)
-    O3N2_index = OIII5006_cor + Ha6562_cor - NII6583_cor
-    eO3N2_index = np.sqrt(eOIII5006_cor**2 + eHa6562_cor**2 + eNII6583_cor**2)
-    # --- N2 (T. Storchi-Bergmann et al. 1994)
-    N2_index = NII6583_cor - Ha6562_cor
-    eN2_index = np.sqrt(eNII6583_cor**2 + eHa6562_cor**2)
-
-    # --- Calibrators
-    
-    ## PP04 calibrator with O3N2 (Pettini & Pagel 2004)
-    O3N2_PP04 = np.where((-1.0 <= O3N2_index) & (O3N2_index <= 1.9), 8.73 - 0.32*O3N2_index, np.nan)
-    eO3N2_PP04 = np.where(np.isfinite(O3N2_PP04), 0.32*eO3N2_index, np.nan)
-    
-    ## PP04 calibrator with N2 (Pettini & Pagel 2004)
-    N2_PP04 = np.where((-2.5 <= N2_index) & (N2_index <= -0.3), 8.90 + 0.57*N2_index, np.nan)
-    eN2_PP04 = np.where(np.isfinite(N2_PP04), 0.57*eN2_index, np.nan)
-    
-    ## M13 calibrator with O3N2 (Marino et al. 2013)
-    O3N2_M13 = np.where((-1.1 <= O3N2_index) & (O3N2_index <= 1.7), 8.533 - 0.214*O3N2_index, np.nan)
-    eO3N2_M13 = np.where(np.isfinite(O3N2_M13), 0.214*eO3N2_index, np.nan)
-    
-    ## M13 calibrator with N2 (Marino et al. 2013)
-    N2_M13 = np.where((-1.6 <= N2_index) & (N2_index <= -0.2), 8.743 + 0.462*N2_index, np.nan)
-    eN2_M13 = np.where(np.isfinite(N2_M13), 0.462*eN2_index, np.nan)
-    
-    ## D16 calibrator (Dopita et al. 2016)
-    # To calculate the flux SII6716,30 = SII6716 + SII6730, it is necessary to revert to the linear flux values 10**(log(F)).
-    F1 = 10**SII6716_cor
-    F2 = 10**SII6730_cor
-    sigma1 = np.log(10) * F1 * eSII6716_cor
-    sigma2 = np.log(10) * F2 * eSII6730_cor
-    # sum and error propagation
-    F_total = F1 + F2
-    sigma_total = np.sqrt(sigma1**2 + sigma2**2)
-    # Calculate the final flux and error of the sum of the SII6716,30 lines
-    SII_total_cor = np.log10(F_total)
-    eSII_total_cor = sigma_total / (F_total * np.log(10))
-    # Here the actual calculation of the D16 calibrator and error propagation begins
-    D16 = 8.77 + (NII6583_cor - SII_total_cor) + 0.264 * (NII6583_cor - Ha6562_cor)
-    eD16 = np.sqrt(eNII6583_cor**2 + eSII_total_cor**2 + (0.264**2) * (eNII6583_cor**2 + eHa6562_cor**2))
-    
+    calibrators = list(CALIBRATORS) if calibrators is None else list(calibrators)
+    need_O3N2 = 1 in calibrators or 3 in calibrators
+    need_N2 = 2 in calibrators or 4 in calibrators or 5 in calibrators
+    need_SII = 5 in calibrators
+    extra = set(lines)
+    lines = (['Ha6562'] + (['OIII5006'] if need_O3N2 or 'OIII5006' in extra else []) + ['NII6583'] +
+             (['SII6716', 'SII6730'] if need_SII or extra & {'SII6716', 'SII6730'} else []))
+
+    def column(name):
+        return np.asarray(flux[name], dtype=dtype)
+
+    out = {} if galaxy is None else {'galaxy': np.asarray(galaxy)}
+    Hb4861, eHb4861 = column('fluxHb4861'), column('e_fluxHb4861')
+    fluxes = {'Hb4861': (Hb4861, eHb4861)}
+    fluxes.update({line: (column('flux' + line), column('e_flux' + line)) for line in lines})
 
-    # --- Quality masks ---
     with np.errstate(invalid='ignore', divide='ignore'):
-        rHb4861 = (eHb4861 < 0.997 * Hb4861) & (Hb4861 > 0)
-        rHa6562 = (eHa6562 < 0.997 * Ha6562) & (Ha6562 > 0)
-        rOIII5006 = (eOIII5006 < 0.997 * OIII5006) & (OIII5006 > 0)
-        rNII6583 = (eNII6583 < 0.997 * NII6583) & (NII6583 > 0)
-        rSII6716 = (eSII6716 < 0.997 * SII6716) & (SII6716 > 0)
-        rSII6730 = (eSII6730 < 0.997 * SII6730) & (SII6730 > 0)
-
-    # --- Apply quality masks according to the index ---
-    def apply_mask(oh, eoh, mask):
-        oh_filtered = np.where(mask, oh, np.nan)
-        eoh_filtered = np.where(mask, np.abs(eoh), np.nan)
-        return oh_filtered, eoh_filtered
-
-    if calibrator in [1, 3]:  # O3N2 index (use 4 lines)
-        mask_ok = rHb4861 & rHa6562 & rOIII5006 & rNII6583
-        if calibrator == 1:
-            oh, eoh = apply_mask(O3N2_PP04, eO3N2_PP04, mask_ok)
-        else:
-            oh, eoh = apply_mask(O3N2_M13, eO3N2_M13, mask_ok)
-    elif calibrator in [2, 4]:  # N2 index (use only Hα and NII)
-        mask_ok = rHa6562 & rNII6583
-        if calibrator == 2:
-            oh, eoh = apply_mask(N2_PP04, eN2_PP04, mask_ok)
+
+        # --- Color excess (Cavichia 2008), times the 0.4 of the correction
+        excess = np.divide(fluxes['Ha6562'][0], Hb4861)
+        np.log10(excess, out=excess)
+        np.subtract(np.log10(2.86), excess, out=excess)
+        excess /= 0.4 * (AV['Ha6562'] - AV['Hb4861'])
+        excess *= 0.4
+
+        # --- Extinction correction and error propagation (the Hb term is shared by every line)
+        rel_Hb4861 = np.divide(eHb4861, Hb4861)
+        np.square(rel_Hb4861, out=rel_Hb4861)
+        for line in lines:
+            flux_line, e_flux_line = fluxes[line]
+            flux_corr = np.divide(flux_line, Hb4861)
+            np.log10(flux_corr, out=flux_corr)
+            flux_corr += excess * (AV[line] - AV['Hb4861'])
+            e_flux_corr = np.divide(e_flux_line, flux_line)
+            np.square(e_flux_corr, out=e_flux_corr)
+            e_flux_corr += rel_Hb4861
+            np.sqrt(e_flux_corr, out=e_flux_corr)
+            e_flux_corr *= 1/np.log(10)
+            out[line + '_cor'] = flux_corr
+            out['e' + line + '_cor'] = e_flux_corr
+        del excess, rel_Hb4861
+
+        Ha6562_cor, eHa6562_cor = out['Ha6562_cor'], out['eHa6562_cor']
+        NII6583_cor, eNII6583_cor = out['NII6583_cor'], out['eNII6583_cor']
+
+        # --- Index
+        if need_O3N2:
+            # --- O3N2 (Alloin et al. 1979)
+            O3N2_index = out['OIII5006_cor'] + Ha6562_cor - NII6583_cor
+            eO3N2_index = np.sqrt(out['eOIII5006_cor']**2 + eHa6562_cor**2 + eNII6583_cor**2)
+            out['O3N2_index'], out['eO3N2_index'] = O3N2_index, eO3N2_index
+        if need_N2:
+            # --- N2 (T. Storchi-Bergmann et al. 1994)
+            N2_index = NII6583_cor - Ha6562_cor
+            eN2_index = np.sqrt(eNII6583_cor**2 + eHa6562_cor**2)
+            out['N2_index'], out['eN2_index'] = N2_index, eN2_index
+
+        # --- Calibrators
+
+        ## PP04 calibrator with O3N2 (Pettini & Pagel 2004)
+        if 1 in calibrators:
+            out['OH_PP04_O3N2'] = np.where((-1.0 <= O3N2_index) & (O3N2_index <= 1.9), 8.73 - 0.32*O3N2_index, np.nan)
+            out['eOH_PP04_O3N2'] = np.where(np.isfinite(out['OH_PP04_O3N2']), 0.32*eO3N2_index, np.nan)
+
+        ## PP04 calibrator with N2 (Pettini & Pagel 2004)
+        if 2 in calibrators:
+            out['OH_PP04_N2'] = np.where((-2.5 <= N2_index) & (N2_index <= -0.3), 8.90 + 0.57*N2_index, np.nan)
+            out['eOH_PP04_N2'] = np.where(np.isfinite(out['OH_PP04_N2']), 0.57*eN2_index, np.nan)
+
+        ## M13 calibrator with O3N2 (Marino et al. 2013)
+        if 3 in calibrators:
+            out['OH_M13_O3N2'] = np.where((-1.1 <= O3N2_index) & (O3N2_index <= 1.7), 8.533 - 0.214*O3N2_index, np.nan)
+            out['eOH_M13_O3N2'] = np.where(np.isfinite(out['OH_M13_O3N2']), 0.214*eO3N2_index, np.nan)
+
+        ## M13 calibrator with N2 (Marino et al. 2013)
+        if 4 in calibrators:
+            out['OH_M13_N2'] = np.where((-1.6 <= N2_index) & (N2_index <= -0.2), 8.743 + 0.462*N2_index, np.nan)
+            out['eOH_M13_N2'] = np.where(np.isfinite(out['OH_M13_N2']), 0.462*eN2_index, np.nan)
+
+        ## D16 calibrator (Dopita et al. 2016)
+        if 5 in calibrators:
+            # To calculate the flux SII6716,30 = SII6716 + SII6730, it is necessary to revert to the linear flux values 10**(log(F)).
+            F1 = 10**out['SII6716_cor']
+            F2 = 10**out['SII6730_cor']
+            sigma1 = np.log(10) * F1 * out['eSII6716_cor']
+            sigma2 = np.log(10) * F2 * out['eSII6730_cor']
+            # sum and error propagation
+            F_total = F1 + F2
+            sigma_total = np.sqrt(sigma1**2 + sigma2**2)
+            # Calculate the final flux and error of the sum of the SII6716,30 lines
+            SII_total_cor = np.log10(F_total)
+            eSII_total_cor = sigma_total / (F_total * np.log(10))
+            # Here the actual calculation of the D16 calibrator and error propagation begins
+            out['OH_D16'] = 8.77 + (NII6583_cor - SII_total_cor) + 0.264 * N2_index
+            out['eOH_D16'] = np.sqrt(eNII6583_cor**2 + eSII_total_cor**2 + (0.264**2) * (eNII6583_cor**2 + eHa6562_cor**2))
+
+        # --- Quality masks ---
+        good = {line: (e_flux_line < 0.997 * flux_line) & (flux_line > 0)
+                for line, (flux_line, e_flux_line) in fluxes.items()}
+
+    # --- Quality mask of each calibrator ---
+    for calibrator in calibrators:
+        if calibrator in [1, 3]:  # O3N2 index (use 4 lines)
+            mask_ok = good['Hb4861'] & good['Ha6562'] & good['OIII5006'] & good['NII6583']
+        elif calibrator in [2, 4]:  # N2 index (use only Hα and NII)
+            mask_ok = good['Ha6562'] & good['NII6583']
+        elif calibrator == 5:  # D16
+            mask_ok = good['Ha6562'] & good['NII6583'] & good['SII6716'] & good['SII6730']
         else:
-            oh, eoh = apply_mask(N2_M13, eN2_M13, mask_ok)
-    elif calibrator == 5:  # D16
-        mask_ok = rHa6562 & rNII6583 & rSII6716 & rSII6730
-        oh, eoh = apply_mask(D16, eD16, mask_ok)
-    else:
+            raise ValueError("Invalid calibrator. Use 1=O3N2_PP04, 2=N2_PP04, 3=O3N2_M13, 4=N2_M13, 5=D16.")
+        out['mask_' + CALIBRATORS[calibrator]] = mask_ok
+
+    return out
+
+
+def corrected_lines(Hb4861, eHb4861, Ha6562, eHa6562, OIII5006, eOIII5006, NII6583, eNII6583,
+                    SII6716, eSII6716, SII6730, eSII6730):
+    """
+    Extinction-corrected lines and the abundances of all five calibrators. Works with arrays or pandas.Series.
+    Returns a dict with the columns of tables/<name>.csv (from Ha6562_cor on) and a dict {calibrator: quality mask}.
+    """
+
+    out = abundance_kernel({'fluxHb4861': Hb4861, 'e_fluxHb4861': eHb4861, 'fluxHa6562': Ha6562, 'e_fluxHa6562': eHa6562,
+                            'fluxOIII5006': OIII5006, 'e_fluxOIII5006': eOIII5006, 'fluxNII6583': NII6583,
+                            'e_fluxNII6583': eNII6583, 'fluxSII6716': SII6716, 'e_fluxSII6716': eSII6716,
+                            'fluxSII6730': SII6730, 'e_fluxSII6730': eSII6730})
+
+    columns = {column: out[column] for column in TABLE_COLUMNS}
+    masks = {calibrator: out['mask_' + name] for calibrator, name in CALIBRATORS.items()}
+    return columns, masks
+
+
+def calibrated(columns, masks, calibrator):
+    """
+    Abundance and error of one calibrator, NaN where its quality mask fails.
+    """
+
+    if calibrator not in CALIBRATORS:
         raise ValueError("Invalid calibrator. Use 1=O3N2_PP04, 2=N2_PP04, 3=O3N2_M13, 4=N2_M13, 5=D16.")
 
-    # --- Salve CSV ---
-    results = pd.DataFrame({
-        'HIIREGID': HIIREGID,
-        'r': r,
-        'EWHa6562': EWHa,
-        'Ha6562_cor': Ha6562_cor,
-        'eHa6562_cor': eHa6562_cor,
-        'OIII5006_cor': OIII5006_cor,
-        'eOIII5006_cor': eOIII5006_cor,
-        'NII6583_cor': NII6583_cor,
-        'eNII6583_cor': eNII6583_cor,
-        'SII6716_cor': SII6716_cor,
-        'eSII6716_cor': eSII6716_cor,
-        'SII6730_cor': SII6730_cor,
-        'eSII6730_cor': eSII6730_cor,
-        'OH_PP04_O3N2': O3N2_PP04,
-        'eOH_PP04_O3N2': eO3N2_PP04,
-        'OH_PP04_N2': N2_PP04,
-        'eOH_PP04_N2': eN2_PP04,
-        'OH_M13_O3N2': O3N2_M13,
-        'eOH_M13_O3N2': eO3N2_M13,
-        'OH_M13_N2': N2_M13,
-        'eOH_M13_N2': eN2_M13,
-        'OH_D16': D16,
-        'eOH_D16': eD16
-    })
-    
+    oh = columns['OH_' + CALIBRATORS[calibrator]]
+    eoh = columns['eOH_' + CALIBRATORS[calibrator]]
+    oh_filtered = np.where(masks[calibrator], oh, np.nan)
+    eoh_filtered = np.where(masks[calibrator], np.abs(eoh), np.nan)
+    return oh_filtered, eoh_filtered
+
+
+def save_table(name, r, HIIREGID, EWHa, columns, sink=None):
+    """
+    Writes tables/<name>.csv, or hands the table to a sinks.Sink.
+    """
+
+    results = pd.DataFrame({'HIIREGID': HIIREGID, 'r': r, 'EWHa6562': EWHa, **columns})
+
+    if sink is not None:
+        sink.write('abundance', {'galaxy': name}, results)
+        return
+
     os.makedirs("tables", exist_ok=True)
     
     results.to_csv(r"tables/"+str(name)+".csv", index=False)
 
-    return oh, eoh, Ha6562_cor, OIII5006_cor, NII6583_cor
 
+def abundance(name, r, HIIREGID, EWHa, Hb4861, eHb4861, Ha6562, eHa6562, 
+              OIII5006, eOIII5006, NII6583, eNII6583, SII6716, eSII6716, SII6730, eSII6730, calibrator, sink=None):
+    """
+    Calculates abundances using the PP04, M13 and D16 calibrators from extinction-corrected fluxes. Works with arrays or pandas.Series.
+    The table is written to tables/<name>.csv, or to sink (a sinks.Sink) when given.
+    """
+
+    columns, masks = corrected_lines(Hb4861, eHb4861, Ha6562, eHa6562, OIII5006, eOIII5006, NII6583, eNII6583,
+                                     SII6716, eSII6716, SII6730, eSII6730)
+    oh, eoh = calibrated(columns, masks, calibrator)
+
+    save_table(name, r, HIIREGID, EWHa, columns, sink)
+
+    return oh, eoh, columns['Ha6562_cor'], columns['OIII5006_cor'], columns['NII6583_cor']
@@ -0,0 +1,437 @@
+import glob
+import os
+import re
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import catalog
+import cube
+import fit_OH
+import models
+import results
+import sinks
+from catalog import FLUX_COLUMNS
+from manifest import Manifest, columns_digest, file_digest, fingerprint
+
+# --- Parameters returned by plot.plot_model, in the order of the summary table
+PARAMS = ['b0', 'eb0', 'a1', 'ea1', 'h1', 'eh1', 'a2', 'ea2', 'h2', 'eh2', 'a3', 'ea3']
+
+FLUX_FILE = re.compile(r'^HII\.(?P<name>.+)\.flux_elines\.csv$')
+
+# --- Output sink of each worker process, created on its first task
+_sinks = {}
+
+# --- fit_shared: numeric columns of the stacked region table, in this order in its shared block
+SHARED_COLUMNS = [column for column in FLUX_COLUMNS if column != 'HIIREGID']
+
+# --- fit_shared: status codes of the shared status array
+SHARED_STATUS = ['pending', 'ok', 'insufficient', 'error']
+
+# --- fit_shared: shared blocks of each worker process, attached once by the pool initializer
+_shared = {}
+
+
+def find_flux_files(flux_files):
+    """
+    Returns a dict {galaxy name: path} from a directory, a glob pattern or a list of HII.<name>.flux_elines.csv files.
+    Spaxel cubes flux_elines.<name>.cube.npy (or .fits, .fits.gz, see cube.py) are found as well.
+    """
+
+    if isinstance(flux_files, (list, tuple)):
+        paths = list(flux_files)
+    elif os.path.isdir(flux_files):
+        paths = (glob.glob(os.path.join(flux_files, 'HII.*.flux_elines.csv')) +
+                 glob.glob(os.path.join(flux_files, 'flux_elines.*.cube.*')))
+    else:
+        paths = glob.glob(flux_files)
+
+    files = {}
+    for path in sorted(paths):
+        match = FLUX_FILE.match(os.path.basename(path)) or cube.CUBE_FILE.match(os.path.basename(path))
+        if match:
+            files[match.group('name')] = path
+    return files
+
+
+def galaxy_arguments(params, flux):
+    """
+    Builds the keyword arguments of fit_OH.fit_final from a row of the galaxy table and a flux_elines table
+    (DataFrame or dict of column arrays).
+    """
+
+    return dict(name=params['galaxy'], HIIREGID=flux['HIIREGID'],
+                ra=flux['RA'], ra0=params['ra0'], dec=flux['DEC'], dec0=params['dec0'],
+                pa=params['pa'], ba=params['ba'], d=params['dist'], re=params['re'],
+                EWHa=flux['EWHa6562'],
+                Hb4861=flux['fluxHb4861'], eHb4861=flux['e_fluxHb4861'],
+                Ha6562=flux['fluxHa6562'], eHa6562=flux['e_fluxHa6562'],
+                OIII5006=flux['fluxOIII5006'], eOIII5006=flux['e_fluxOIII5006'],
+                NII6583=flux['fluxNII6583'], eNII6583=flux['e_fluxNII6583'],
+                SII6716=flux['fluxSII6716'], eSII6716=flux['e_fluxSII6716'],
+                SII6730=flux['fluxSII6730'], eSII6730=flux['e_fluxSII6730'])
+
+
+def _worker_sink(mode, root):
+    if (mode, root) not in _sinks:
+        _sinks[(mode, root)] = sinks.make_sink(mode, root)
+    return _sinks[(mode, root)]
+
+
+def _drain(sink):
+    # --- Waits for the writes queued by a failed fit; their errors are those of the same galaxy, already reported
+    if sink is not None:
+        try:
+            sink.flush()
+        except Exception:
+            pass
+
+
+def _fit_columns(params, flux, calibrator, criterion, save_table, save_graph, fit_options, sink_mode=None, sink_root=None,
+                 profile=False, profile_dir=None, keep_figure=False, profile_memory=False):
+    """
+    Worker: fits one galaxy and returns a row of the summary table. Failures are returned, not raised.
+    The tables of the galaxy are written (the sink flushed) before the row is returned, so a failed write makes the
+    row an error and a row 'ok' means its tables are on disk. With profile, the profiling record of the galaxy is
+    returned in the row under 'profile'; with keep_figure, the numeric content of its figure under 'figure'.
+    """
+
+    row = {'galaxy': params['galaxy'], 'calibrator': calibrator, 'criterion': criterion,
+           'status': 'ok', 'error': ''}
+    sink = None
+    try:
+        if cube.is_cube(flux):
+            flux = cube.spaxel_columns(flux, params)
+        elif isinstance(flux, str):
+            flux = pd.read_csv(flux, usecols=FLUX_COLUMNS)
+        sink = _worker_sink(sink_mode, sink_root)
+        output = fit_OH.fit_final(calibrator=calibrator, criterion=criterion, save_table=save_table,
+                                  save_graph=save_graph, show_graph=False, sink=sink, **fit_options,
+                                  profile=profile, profile_dir=profile_dir, profile_memory=profile_memory,
+                                  **galaxy_arguments(params, flux))
+        if profile:
+            output, row['profile'] = output
+        if sink is not None:
+            sink.flush()
+        if output is None:
+            row['status'] = 'insufficient'
+        else:
+            row.update({key: output[key] for key in PARAMS})
+            if keep_figure:
+                row['figure'] = output['figure']
+    except Exception as error:
+        _drain(sink)
+        row['status'] = 'error'
+        row['error'] = ''.join(traceback.format_exception_only(type(error), error)).strip()
+    return row
+
+
+def _open_manifest(manifest):
+    # --- A path opens (and later closes) a Manifest; a Manifest instance is used as is
+    return Manifest(manifest) if isinstance(manifest, str) else manifest
+
+
+def _fingerprint(digest, params, calibrator, criterion, fit_options, outputs):
+    # --- The files a fit writes are part of it: a rerun asking for tables, graphs or another sink refits the galaxy
+    return fingerprint(digest, params=params, calibrator=calibrator, criterion=criterion,
+                       engine=fit_options['engine'], n_boot=fit_options['n_boot'], seed=fit_options['seed'],
+                       binning=fit_options['binning'], fit2=models.FIT2, fit3=models.FIT3, **outputs)
+
+
+def _outputs(save_table, save_graph, sink, sink_root):
+    return {'save_table': save_table, 'save_graph': save_graph, 'sink': sink,
+            'sink_root': None if sink_root is None else os.path.abspath(sink_root)}
+
+
+def _collect(future, galaxy, key, rows, calibrator, criterion, manifest):
+    # --- A row is only 'ok' once the worker flushed the tables of its galaxy, so a checkpointed galaxy never has
+    # --- writes still queued in a worker that may be killed
+    try:
+        row = future.result()
+    except Exception as error:  # e.g. a worker killed by the OS
+        row = {'galaxy': galaxy, 'calibrator': calibrator, 'criterion': criterion,
+               'status': 'error', 'error': repr(error)}
+    rows.append(row)
+    if manifest is not None:
+        manifest.record(galaxy, calibrator, criterion, key, row)
+
+
+def _summary(rows, summary_file):
+    summary = pd.DataFrame(rows, columns=['galaxy', 'calibrator', 'criterion', 'status', 'error'] + PARAMS)
+    summary = summary.sort_values('galaxy', kind='stable').reset_index(drop=True)
+
+    if summary_file is not None:
+        summary.to_csv(summary_file, index=False)
+
+    return summary
+
+
+def _result(rows, summary_file, profile, render_mode=None, render_path=None, n_workers=None):
+    figures = [row.pop('figure') for row in rows if 'figure' in row]
+    if render_mode is not None:
+        import render
+        render.render_many(sorted(figures, key=lambda data: str(data['galaxy'])), render_mode, render_path,
+                           n_jobs=n_workers or os.cpu_count() or 1)
+
+    summary = _summary(rows, summary_file)
+    if profile:
+        return summary, [row['profile'] for row in rows if row.get('profile')]
+    return summary
+
+
+def fit_survey(galaxy_table, flux_files, calibrator, criterion, n_workers=None,
+               save_table=False, save_graph=False, summary_file=None,
+               engine='piecewise_regression', n_boot=200, seed=None, cache=None, sink=None, sink_root=None,
+               profile=False, profile_dir=None, render=None, render_path=None, manifest=None, binning=None,
+               profile_memory=False):
+    """
+    Fits every galaxy of galaxy_table (DataFrame or CSV with the columns of data_NGC0309.csv) over a process pool.
+    flux_files is a directory, a glob pattern or a list of HII.<name>.flux_elines.csv files or spaxel cubes.
+    engine, n_boot, seed and cache (a cache.FitCache shared by the workers) are passed to models.fit_models, and
+    binning (options of binning.radial_bins) to fit_OH.fit_final.
+    sink ('none', 'csv' or 'parquet', see sinks.make_sink) selects how the tables are written, under sink_root.
+    Returns one summary table with a row per galaxy; failures are recorded in the 'status' and 'error' columns.
+    With profile, returns (summary, records): the profiling records of the fitted galaxies (see fit_OH.fit_final;
+    profiling.aggregate gives p50/p95 per stage), with cProfile dumps in profile_dir if given; profile_memory adds
+    the peak memory of the stages, at the cost of much slower (so unrepresentative) timings.
+    render ('png', 'pdf' or 'sheet', see render.render_many) draws the figures after the fits, from their numeric
+    results and over the same number of processes, to render_path; save_graph instead draws them inside the workers.
+    manifest (a path or a manifest.Manifest) checkpoints every finished galaxy with a fingerprint of its flux file,
+    its parameters, the fit settings and the outputs asked for (save_table, save_graph, sink, sink_root); a rerun
+    with the same manifest reuses the rows of the galaxies that are done and unchanged, and fits only the others
+    (skipped galaxies have no profile record or figure).
+    """
+
+    if not isinstance(galaxy_table, pd.DataFrame):
+        galaxy_table = pd.read_csv(galaxy_table)
+
+    files = find_flux_files(flux_files)
+    fit_options = {'engine': engine, 'n_boot': n_boot, 'seed': seed, 'cache': cache, 'binning': binning}
+    outputs = _outputs(save_table, save_graph, sink, sink_root)
+    run_manifest = _open_manifest(manifest)
+    rows = []
+
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {}
+            for params in galaxy_table.to_dict('records'):
+                path = files.get(params['galaxy'])
+                if path is None:
+                    rows.append({'galaxy': params['galaxy'], 'calibrator': calibrator, 'criterion': criterion,
+                                 'status': 'missing', 'error': 'flux_elines file not found'})
+                    continue
+                key = None
+                if run_manifest is not None:
+                    key = _fingerprint(file_digest(path), params, calibrator, criterion, fit_options, outputs)
+                    row = run_manifest.done(params['galaxy'], calibrator, criterion, key)
+                    if row is not None:
+                        rows.append(row)
+                        continue
+                future = executor.submit(_fit_columns, params, path, calibrator, criterion, save_table, save_graph,
+                                         fit_options, sink, sink_root, profile, profile_dir,
+                                         render is not None, profile_memory)
+                futures[future] = (params['galaxy'], key)
+
+            for future in as_completed(futures):
+                _collect(future, *futures[future], rows, calibrator, criterion, run_manifest)
+    finally:
+        if run_manifest is not None and run_manifest is not manifest:
+            run_manifest.close()
+
+    return _result(rows, summary_file, profile, render, render_path, n_workers)
+
+
+def fit_catalog(galaxy_table, catalog_path, calibrator, criterion, n_workers=None,
+                save_table=False, save_graph=False, summary_file=None,
+                engine='piecewise_regression', n_boot=200, seed=None, cache=None, sink=None, sink_root=None,
+                chunksize=100000, flux_dtype=np.float64, profile=False, profile_dir=None,
+                render=None, render_path=None, manifest=None, binning=None, profile_memory=False):
+    """
+    Like fit_survey, but streams the regions of all galaxies from one concatenated flux_elines catalog
+    (see catalog.iter_galaxies). At most 2*n_workers galaxies are read ahead of the workers, so memory is bounded
+    by a few galaxies and not by the catalog. With manifest, the fingerprint of a galaxy is taken from its columns.
+    """
+
+    if not isinstance(galaxy_table, pd.DataFrame):
+        galaxy_table = pd.read_csv(galaxy_table)
+
+    galaxies = {params['galaxy']: params for params in galaxy_table.to_dict('records')}
+    fit_options = {'engine': engine, 'n_boot': n_boot, 'seed': seed, 'cache': cache, 'binning': binning}
+    galaxy_stream = catalog.iter_galaxies(catalog_path, chunksize, flux_dtype)
+    outputs = _outputs(save_table, save_graph, sink, sink_root)
+    run_manifest = _open_manifest(manifest)
+    rows = []
+
+    def collect(futures, done):
+        for future in done:
+            _collect(future, *futures.pop(future), rows, calibrator, criterion, run_manifest)
+
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            max_pending = 2 * (n_workers or os.cpu_count() or 1)
+            futures = {}
+            seen = set()
+            for name, columns in galaxy_stream:
+                seen.add(name)
+                params = galaxies.get(name)
+                if params is None:
+                    rows.append({'galaxy': name, 'calibrator': calibrator, 'criterion': criterion,
+                                 'status': 'missing', 'error': 'galaxy parameters not found'})
+                    continue
+                key = None
+                if run_manifest is not None:
+                    key = _fingerprint(columns_digest(columns), params, calibrator, criterion, fit_options, outputs)
+                    row = run_manifest.done(name, calibrator, criterion, key)
+                    if row is not None:
+                        rows.append(row)
+                        continue
+                if len(futures) >= max_pending:
+                    collect(futures, wait(futures, return_when=FIRST_COMPLETED).done)
+                future = executor.submit(_fit_columns, params, columns, calibrator, criterion, save_table, save_graph,
+                                         fit_options, sink, sink_root, profile, profile_dir,
+                                         render is not None, profile_memory)
+                futures[future] = (name, key)
+
+            collect(futures, wait(futures).done)
+    finally:
+        if run_manifest is not None and run_manifest is not manifest:
+            run_manifest.close()
+
+    for name in galaxies.keys() - seen:
+        rows.append({'galaxy': name, 'calibrator': calibrator, 'criterion': criterion,
+                     'status': 'missing', 'error': 'galaxy not found in the catalog'})
+
+    return _result(rows, summary_file, profile, render, render_path, n_workers)
+
+
+def _shared_block(shape, dtype):
+    dtype = np.dtype(dtype)
+    block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def _attach_shared(layout):
+    """
+    Pool initializer: attaches the shared blocks of fit_shared ({key: (name, shape, dtype)}) in the worker.
+    """
+
+    for key, (name, shape, dtype) in layout.items():
+        block = shared_memory.SharedMemory(name=name)
+        _shared[key] = (block, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+
+
+def _fit_shared(index, params, start, stop, calibrator, criterion, save_table, fit_options, sink_mode, sink_root):
+    """
+    Worker of fit_shared: fits the regions start:stop of the shared table (zero-copy views) and writes the record
+    of the fit and its status in row index of the shared outputs. Returns only the error message, if any.
+    """
+
+    table = _shared['table'][1]
+    flux = {column: table[j, start:stop] for j, column in enumerate(SHARED_COLUMNS)}
+    flux['HIIREGID'] = _shared['HIIREGID'][1][start:stop].astype(str)
+    records, status = _shared['results'][1], _shared['status'][1]
+
+    sink = None
+    try:
+        sink = _worker_sink(sink_mode, sink_root)
+        output = fit_OH.fit_final(calibrator=calibrator, criterion=criterion, save_table=save_table,
+                                  save_graph=False, show_graph=False, sink=sink, **fit_options,
+                                  **galaxy_arguments(params, flux))
+        if sink is not None:
+            sink.flush()
+        if output is None:
+            status[index] = SHARED_STATUS.index('insufficient')
+        else:
+            records[index] = output['result'].record
+            status[index] = SHARED_STATUS.index('ok')
+        return ''
+    except Exception as error:
+        _drain(sink)
+        status[index] = SHARED_STATUS.index('error')
+        return ''.join(traceback.format_exception_only(type(error), error)).strip()
+
+
+def fit_shared(galaxy_table, catalog_path, calibrator, criterion, n_workers=None,
+               save_table=False, summary_file=None,
+               engine='piecewise_regression', n_boot=200, seed=None, cache=None, sink=None, sink_root=None,
+               binning=None):
+    """
+    Like fit_catalog, for catalogs that fit in memory: the stacked region table (a flux_elines catalog as a CSV
+    or DataFrame, see catalog.iter_galaxies) is placed once in shared memory, grouped by galaxy. Tasks only carry
+    the galaxy parameters and its range of rows; workers read zero-copy NumPy views and write the record of each
+    fit (results.RESULT_DTYPE) into a preallocated shared array, so no region columns or fit results are pickled.
+    Returns (summary, records): the summary table of fit_survey and the structured array of the records, one per
+    row of galaxy_table (NaN estimates when not fitted).
+    """
+
+    if not isinstance(galaxy_table, pd.DataFrame):
+        galaxy_table = pd.read_csv(galaxy_table)
+    if not isinstance(catalog_path, pd.DataFrame):
+        catalog_path = pd.read_csv(catalog_path, usecols=FLUX_COLUMNS, dtype=catalog.flux_dtypes())
+
+    # --- Regions grouped by galaxy (stable, so their order in the catalog is kept)
+    names = catalog.galaxy_names(catalog_path['HIIREGID'])
+    order = np.argsort(names, kind='stable')
+    galaxy_names, starts, counts = np.unique(names[order], return_index=True, return_counts=True)
+    ranges = {name: (start, start + count) for name, start, count in zip(galaxy_names, starts, counts)}
+
+    n_regions, n_galaxies = len(order), len(galaxy_table)
+    region_ids = catalog_path['HIIREGID'].to_numpy().astype(str)[order]
+    blocks = {'table': _shared_block((len(SHARED_COLUMNS), n_regions), np.float64),
+              'HIIREGID': _shared_block((n_regions,), 'S{}'.format(max(1, max(map(len, region_ids), default=1)))),
+              'results': _shared_block((n_galaxies,), results.RESULT_DTYPE),
+              'status': _shared_block((n_galaxies,), np.int8)}
+
+    try:
+        table = blocks['table'][1]
+        for j, column in enumerate(SHARED_COLUMNS):
+            table[j] = catalog_path[column].to_numpy(dtype=np.float64)[order]
+        blocks['HIIREGID'][1][:] = np.char.encode(region_ids)
+        blocks['results'][1][:] = results.empty_record()
+        blocks['status'][1][:] = SHARED_STATUS.index('pending')
+        del region_ids, table
+        layout = {key: (block.name, array.shape, array.dtype) for key, (block, array) in blocks.items()}
+
+        fit_options = {'engine': engine, 'n_boot': n_boot, 'seed': seed, 'cache': cache, 'binning': binning}
+        errors = {}
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_attach_shared, initargs=(layout,)) as executor:
+            futures = {}
+            for index, params in enumerate(galaxy_table.to_dict('records')):
+                if params['galaxy'] not in ranges:
+                    errors[index] = 'galaxy not found in the catalog'
+                    continue
+                start, stop = ranges[params['galaxy']]
+                future = executor.submit(_fit_shared, index, params, start, stop, calibrator, criterion, save_table,
+                                         fit_options, sink, sink_root)
+                futures[future] = index
+
+            for future in as_completed(futures):
+                try:
+                    errors[futures[future]] = future.result()
+                except Exception as error:  # e.g. a worker killed by the OS
+                    errors[futures[future]] = repr(error)
+
+        records = blocks['results'][1].copy()
+        status = blocks['status'][1].copy()
+    finally:
+        for block, array in blocks.values():
+            del array
+            block.close()
+            block.unlink()
+
+    rows = []
+    for index, name in enumerate(galaxy_table['galaxy']):
+        row = {'galaxy': name, 'calibrator': calibrator, 'criterion': criterion,
+               'status': SHARED_STATUS[status[index]], 'error': errors.get(index, '')}
+        if name not in ranges:
+            row['status'] = 'missing'
+        elif row['status'] == 'pending':
+            row['status'] = 'error'
+        elif row['status'] == 'ok':
+            row.update(results.best_parameters(records[index]))
+        rows.append(row)
+
+    return _summary(rows, summary_file), records
@@ -0,0 +1,41 @@
+"""
+Import-time benchmark: startup cost of a worker that only needs abundances (lazy imports) against one that loads
+every stage, as fit_OH did before models and plot were imported on demand.
+
+    python benchmarks/import_time.py [repeats]
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = {
+    'import fit_OH (lazy)': 'import fit_OH',
+    'import fit_OH + models + plot (eager)': ('import fit_OH, models, plot; import matplotlib.pyplot; '
+                                              'import statsmodels.api, piecewise_regression'),
+    'python startup + numpy + pandas': 'import numpy, pandas',
+}
+
+
+def time_import(statement, repeats):
+    """
+    Median wall time of a fresh interpreter running statement.
+    """
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], cwd=ROOT, check=True,
+                       env=dict(os.environ, MPLBACKEND='Agg'))
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for label, statement in CASES.items():
+        print('{:40s} {:7.3f} s'.format(label, time_import(statement, repeats)))
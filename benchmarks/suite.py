@@ -0,0 +1,208 @@
+"""
+Benchmark suite on synthetic galaxies (see synthetic.py): times distance.distances, abundance.abundance,
+criteria.points, models.fit_models, plot.plot_model (saving its PNG) and the rendering of a figure separately over region counts,
+and batch.fit_survey end to end over worker counts. Results are written to JSON, with the versions and commit they were measured on.
+
+    python benchmarks/suite.py [--sizes 100 1000 ...] [--workers 1 2 4] [--output bench.json]
+    python benchmarks/suite.py --compare old.json new.json [--threshold 1.2]
+"""
+
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import numpy as np  # noqa: E402
+
+import synthetic  # noqa: E402
+import distance  # noqa: E402
+import abundance  # noqa: E402
+import criteria  # noqa: E402
+import batch  # noqa: E402
+import sinks  # noqa: E402
+import render  # noqa: E402
+
+
+def _measure(function, repeats):
+    """
+    Wall times of repeats calls of function, after one warm-up call (lazy imports, caches).
+    """
+
+    function()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _entry(times, **labels):
+    return dict(labels, times=times, median=statistics.median(times), min=min(times))
+
+
+def stage_benchmarks(sizes, engines, max_fit_size, repeats, seed):
+    """
+    Times every stage on one synthetic galaxy per size. The fits and the plot only run up to max_fit_size regions.
+    """
+
+    import models
+    import plot
+
+    results = []
+    for n in sizes:
+        params, flux, _ = synthetic.galaxy('BENCH', n, n_breakpoints=1, seed=seed)
+        args = batch.galaxy_arguments(params, flux)
+        null = sinks.NullSink()
+
+        def run_distance():
+            return distance.distances(args['ra'], args['ra0'], args['dec'], args['dec0'], args['pa'], args['ba'],
+                                      args['d'], args['re'])
+        x = run_distance()
+
+        def run_abundance():
+            return abundance.abundance('BENCH', x, args['HIIREGID'], args['EWHa'], args['Hb4861'], args['eHb4861'],
+                                       args['Ha6562'], args['eHa6562'], args['OIII5006'], args['eOIII5006'],
+                                       args['NII6583'], args['eNII6583'], args['SII6716'], args['eSII6716'],
+                                       args['SII6730'], args['eSII6730'], 1, null)
+        y, ey, Ha6562_cor, OIII5006_cor, NII6583_cor = run_abundance()
+
+        def run_criteria():
+            return criteria.points('BENCH', 'KA03', x, y, ey, args['EWHa'], Ha6562_cor, OIII5006_cor, NII6583_cor,
+                                   1, False)
+        r, oh, eoh = run_criteria()
+
+        results.append(_entry(_measure(run_distance, repeats), stage='distance', n_regions=n))
+        results.append(_entry(_measure(run_abundance, repeats), stage='abundance', n_regions=n))
+        results.append(_entry(_measure(run_criteria, repeats), stage='criteria', n_regions=n))
+
+        if n > max_fit_size:
+            continue
+        fit = None
+        for engine in engines:
+            fit = models.fit_models(r, oh, eoh, engine=engine, seed=seed)
+            results.append(_entry(_measure(lambda: models.fit_models(r, oh, eoh, engine=engine, seed=seed), repeats),
+                                  stage='models', engine=engine, n_regions=n))
+        if fit is not None:
+            # --- plot_model only draws when saving or showing: time it saving graphs/BENCH_*.png in a scratch folder
+            cwd = os.getcwd()
+            with tempfile.TemporaryDirectory() as folder:
+                os.chdir(folder)
+                try:
+                    results.append(_entry(_measure(lambda: plot.plot_model(fit, 'BENCH', 'KA03', 1, True, False),
+                                                   repeats), stage='plot', n_regions=n))
+                finally:
+                    os.chdir(cwd)
+            template = render.FigureTemplate()
+            data = plot.figure_data(fit, 'BENCH', 'KA03', 1)
+
+            def run_render():
+                template.update(data)
+                template.save(io.BytesIO())
+            results.append(_entry(_measure(run_render, repeats), stage='render', n_regions=n))
+            template.close()
+        print('stages: {} regions done'.format(n), file=sys.stderr)
+    return results
+
+
+def end_to_end_benchmarks(n_galaxies, n_regions, workers, engines, seed):
+    """
+    Times batch.fit_survey over n_galaxies synthetic galaxies written to a temporary folder, per worker count.
+    """
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        galaxy_table, catalog, _ = synthetic.survey(n_galaxies, n_regions, seed=seed)
+        synthetic.write_survey(folder, galaxy_table, catalog)
+        for engine in engines:
+            for n_workers in workers:
+                start = time.perf_counter()
+                summary = batch.fit_survey(os.path.join(folder, 'galaxies.csv'), folder, 1, 'KA03',
+                                           n_workers=n_workers, engine=engine, seed=seed, sink='none')
+                wall = time.perf_counter() - start
+                results.append({'n_galaxies': n_galaxies, 'n_regions': n_regions, 'n_workers': n_workers,
+                                'engine': engine, 'wall': wall, 'per_galaxy': wall / n_galaxies,
+                                'ok': int((summary['status'] == 'ok').sum())})
+                print('end to end: {} with {} workers done'.format(engine, n_workers), file=sys.stderr)
+    return results
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': commit,
+            'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'cpu_count': os.cpu_count()}
+
+
+def _key(entry):
+    return tuple((name, entry[name]) for name in ('stage', 'engine', 'n_regions', 'n_galaxies', 'n_workers')
+                 if name in entry)
+
+
+def compare(old_file, new_file, threshold):
+    """
+    Prints the new/old ratio of every benchmark present in both files (median for stages, wall for end to end)
+    and returns the number of regressions (ratio above threshold).
+    """
+
+    with open(old_file) as file:
+        old = json.load(file)
+    with open(new_file) as file:
+        new = json.load(file)
+
+    regressions = 0
+    for section, value in (('stages', 'median'), ('end_to_end', 'wall')):
+        before = {_key(entry): entry[value] for entry in old.get(section, [])}
+        for entry in new.get(section, []):
+            key = _key(entry)
+            if key not in before or before[key] <= 0:
+                continue
+            ratio = entry[value] / before[key]
+            flag = 'REGRESSION' if ratio > threshold else ''
+            regressions += ratio > threshold
+            label = ' '.join('{}={}'.format(name, item) for name, item in key)
+            print('{:60s} {:10.4f} -> {:10.4f} s  x{:5.2f} {}'.format(label, before[key], entry[value], ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument('--engines', nargs='+', default=['piecewise_regression', 'native', 'grid'])
+    parser.add_argument('--max-fit-size', type=int, default=2000)
+    parser.add_argument('--galaxies', type=int, default=12)
+    parser.add_argument('--galaxy-size', type=int, default=300)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    parser.add_argument('--threshold', type=float, default=1.2)
+    options = parser.parse_args()
+
+    if options.compare:
+        sys.exit(1 if compare(*options.compare, options.threshold) else 0)
+
+    report = {'meta': metadata(),
+              'settings': {key: value for key, value in vars(options).items() if key not in ('compare', 'threshold')},
+              'stages': stage_benchmarks(options.sizes, options.engines, options.max_fit_size, options.repeats,
+                                         options.seed),
+              'end_to_end': end_to_end_benchmarks(options.galaxies, options.galaxy_size, options.workers,
+                                                  options.engines, options.seed)}
+    with open(options.output, 'w') as file:
+        json.dump(report, file, indent=1, default=float)
+    print('written to {}'.format(options.output), file=sys.stderr)
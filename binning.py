@@ -0,0 +1,80 @@
+import numpy as np
+
+from models import MIN_POINTS
+
+## Radial binning of the selected points before the fits, for galaxies with thousands of points (well-resolved
+## catalogs, spaxels): the cost of the breakpoint fits then depends on the number of bins and not on the density of
+## the data. Each bin gives the error-weighted mean radius and OH of its points, the propagated error and the number
+## of raw points it holds.
+
+
+def bin_edges(r, mode='count', n_bins=50, width=0.1):
+    """
+    Edges of the radial bins: fixed width in r/re from 0 (mode='width') or n_bins bins of equal counts
+    (mode='count').
+    """
+
+    if mode == 'width':
+        return np.arange(int(r.max() // width) + 2) * width
+    elif mode == 'count':
+        return np.unique(np.quantile(r, np.linspace(0, 1, n_bins + 1)))
+    else:
+        raise ValueError("Invalid binning mode. Use 'width' or 'count'.")
+
+
+def _bin(r, oh, eoh, edges, min_count, errors):
+    index = np.clip(np.searchsorted(edges, r, side='right') - 1, 0, len(edges) - 2)
+    w = 1/eoh**2
+    counts = np.bincount(index, minlength=len(edges) - 1)
+    sum_w = np.bincount(index, w, minlength=len(edges) - 1)
+    keep = counts >= min_count
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rb = np.bincount(index, w*r, minlength=len(edges) - 1) / sum_w
+        ohb = np.bincount(index, w*oh, minlength=len(edges) - 1) / sum_w
+        if errors == 'propagated':
+            eohb = 1/np.sqrt(sum_w)
+        elif errors == 'scatter':
+            # --- Standard error of the weighted mean from the scatter of the points
+            residuals = np.bincount(index, w*(oh - ohb[index])**2, minlength=len(edges) - 1)
+            eohb = np.sqrt(residuals / sum_w / np.maximum(counts - 1, 1))
+        else:
+            raise ValueError("Invalid binning errors. Use 'propagated' or 'scatter'.")
+
+    return rb[keep], ohb[keep], eohb[keep], counts[keep]
+
+
+def radial_bins(r, oh, eoh, mode='count', n_bins=50, width=0.1, min_count=3, max_points=None, errors='propagated'):
+    """
+    Bins the points (r, oh, eoh) of criteria.points in radius, with weights 1/eoh**2. Points whose eoh is not
+    positive and finite (no usable weight) are left out of the bins.
+    mode='width' uses bins of width r/re, mode='count' n_bins bins of equal counts; bins with fewer than min_count
+    points are dropped. errors='propagated' gives 1/sqrt(sum of the weights), errors='scatter' the standard error of
+    the weighted mean from the scatter of the points in the bin.
+    Galaxies with at most max_points points (when given) are not binned. If fewer than MIN_POINTS bins remain, the
+    points are binned again into MIN_POINTS bins of equal counts, or kept as they are when there are fewer than
+    MIN_POINTS*min_count of them, so binning never decides alone whether a galaxy is fitted.
+    Returns (r, oh, eoh, counts), counts being the number of raw points of each bin (ones when not binned).
+    """
+
+    r = np.asarray(r, dtype=float)
+    oh = np.asarray(oh, dtype=float)
+    eoh = np.asarray(eoh, dtype=float)
+    unbinned = (r, oh, eoh, np.ones(len(r), dtype=np.int64))
+
+    if len(r) == 0 or (max_points is not None and len(r) <= max_points):
+        return unbinned
+
+    # --- A zero error would give an infinite weight and a NaN bin
+    weighted = np.isfinite(eoh) & (eoh > 0)
+    r, oh, eoh = r[weighted], oh[weighted], eoh[weighted]
+    if len(r) == 0:
+        return unbinned
+
+    binned = _bin(r, oh, eoh, bin_edges(r, mode, n_bins, width), min_count, errors)
+    if len(binned[0]) >= MIN_POINTS:
+        return binned
+
+    if len(r) < MIN_POINTS * min_count:
+        return unbinned
+    return _bin(r, oh, eoh, bin_edges(r, 'count', MIN_POINTS), min_count, errors)
@@ -0,0 +1,436 @@
+import itertools
+
+import numpy as np
+
+## Continuous piecewise-linear fits with Muggeo's iterative method (Muggeo 2003) and bootstrap restarting (Wood 2001).
+## Same model, constraints and reported quantities as piecewise_regression.Fit (Pilgrim 2021), but every bootstrap
+## resample is solved in the same stacked NumPy call instead of one statsmodels fit per resample and iteration.
+
+
+def _design(x, psi):
+    """
+    Design matrices [1, x, (x-psi)+, H(x-psi)] for a stack of breakpoint vectors psi of shape (fits, k).
+    """
+
+    u = x[None, :, None] - psi[:, None, :]
+    v = (u >= 0).astype(float)
+    ones = np.ones(u.shape[:2] + (1,))
+    return np.concatenate([ones, x[None, :, None] * ones, u * v, v], axis=2)
+
+
+def _valid(psi, bounds, min_gap):
+    """
+    True for the rows of psi whose breakpoints are inside the allowed range and far enough apart.
+    """
+
+    with np.errstate(invalid='ignore'):
+        ok = np.all(np.isfinite(psi), axis=1) & np.all((psi > bounds[0]) & (psi < bounds[1]), axis=1)
+        if psi.shape[1] > 1:
+            ok &= np.all(np.diff(psi, axis=1) > min_gap, axis=1)
+    return ok
+
+
+def _predict(x, params, psi):
+    """
+    Model values for a stack of (const, alpha1, betas) parameters and breakpoints.
+    """
+
+    k = psi.shape[1]
+    y = params[:, 0, None] + params[:, 1, None] * x
+    for j in range(k):
+        y = y + params[:, 2 + j, None] * np.maximum(x - psi[:, j, None], 0)
+    return y
+
+
+def _muggeo_batch(x, y, w, psi, bounds, min_gap, max_iterations, tolerance):
+    """
+    Runs Muggeo's iterations on a stack of problems sharing x.
+    y is (n,) or (fits, n), w is None or (fits, n) weights (bootstrap counts, or 0/1 to leave points out),
+    psi (fits, k) are the start values. The bounds and min_gap are scalars or per-fit arrays.
+    Returns, per fit, the breakpoints of the best (lowest RSS) iteration before and after its update, its RSS and
+    whether the iterations converged, with the same stopping rules as piecewise_regression.
+    """
+
+    n_fits, k = psi.shape
+    y = np.broadcast_to(y, (n_fits, x.size))
+    sw = None if w is None else np.sqrt(w)
+    lower = np.broadcast_to(bounds[0], (n_fits,))[:, None]
+    upper = np.broadcast_to(bounds[1], (n_fits,))[:, None]
+    min_gap = np.broadcast_to(min_gap, (n_fits,))[:, None]
+
+    best_current = np.full((n_fits, k), np.nan)
+    best_next = np.full((n_fits, k), np.nan)
+    best_rss = np.full(n_fits, np.inf)
+    converged = np.zeros(n_fits, dtype=bool)
+
+    current = np.sort(psi, axis=1)
+    previous = np.full_like(current, np.nan)
+    active = _valid(current, (lower, upper), min_gap)
+
+    for iteration in range(max_iterations + 1):
+        rows = np.flatnonzero(active)
+        if rows.size == 0:
+            break
+
+        Z = _design(x, current[rows])
+        yr = y[rows]
+        if sw is not None:
+            Z = Z * sw[rows, :, None]
+            yr = yr * sw[rows]
+
+        # --- All fits of this iteration in one batched least-squares solve (normal equations)
+        Zt = Z.transpose(0, 2, 1)
+        ZtZ = Zt @ Z
+        Zty = (Zt @ yr[..., None])[..., 0]
+        try:
+            params = np.linalg.solve(ZtZ, Zty[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            params = np.einsum('fpq,fq->fp', np.linalg.pinv(ZtZ, hermitian=True), Zty)
+        beta = params[:, 2:2 + k]
+        gamma = params[:, 2 + k:]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            nxt = np.sort(current[rows] - gamma / beta, axis=1)
+        ok = _valid(nxt, (lower[rows], upper[rows]), min_gap[rows])
+
+        resid = y[rows] - _predict(x, params, nxt)
+        rss = np.sum(resid**2 if w is None else w[rows] * resid**2, axis=1)
+
+        better = ok & (rss < best_rss[rows])
+        best_current[rows[better]] = current[rows[better]]
+        best_next[rows[better]] = nxt[better]
+        best_rss[rows[better]] = rss[better]
+
+        # --- Stop when the breakpoints stop moving (or cycle between two values), leave the range or come too close
+        done = ~ok
+        if iteration >= 1:
+            conv = np.max(np.abs(nxt - current[rows]), axis=1) <= tolerance
+            if iteration >= 2:
+                conv |= np.max(np.abs(nxt - previous[rows]), axis=1) <= tolerance
+            conv &= ok
+            converged[rows[conv]] = True
+            done |= conv
+
+        previous[rows] = current[rows]
+        current[rows] = nxt
+        active[rows[done]] = False
+
+    return best_current, best_next, best_rss, converged
+
+
+def _restart_batch(x, y, counts, starts, bounds, min_gap, max_iterations, tolerance):
+    """
+    Bootstrap restarting for a block of resamples: fit each resample (given as multiplicity counts) from its start
+    values, then refit the original data from the breakpoints found.
+    """
+
+    _, boot_next, _, boot_converged = _muggeo_batch(x, y, counts, starts, bounds, min_gap, max_iterations, tolerance)
+    starts = np.where(boot_converged[:, None], boot_next, starts)
+    return _muggeo_batch(x, y, None, starts, bounds, min_gap, max_iterations, tolerance)
+
+
+def _sufficient_statistics(x, y, w):
+    """
+    Sorted x and the suffix sums of w, wx, wx^2, wy, wxy (column i sums the points i..n-1), with y centred on its
+    weighted mean, and the weighted sum of squares of the centred y.
+    """
+
+    order = np.argsort(x, kind='stable')
+    x, y, w = x[order], y[order], w[order]
+    y = y - np.sum(w * y) / np.sum(w)
+    terms = np.stack([w, w * x, w * x**2, w * y, w * x * y])
+    sums = np.zeros((5, x.size + 1))
+    sums[:, :-1] = np.cumsum(terms[:, ::-1], axis=1)[:, ::-1]
+    return x, sums, np.sum(w * y**2)
+
+
+def _grid_rss(x_sorted, sums, syy, psi, inner_slope=True, return_params=False):
+    """
+    RSS of the least-squares continuous piecewise-linear fit for each row of sorted breakpoints psi (fits, k),
+    from the suffix sums only: O(k^2) per candidate whatever the number of points. inner_slope=False fixes the
+    slope before the first breakpoint to zero (flat inner plateau). With return_params, also returns the
+    coefficients [const, slope, beta1..betak] (const of the centred y; slope 0 without inner_slope).
+    """
+
+    n_fits, k = psi.shape
+    T0, T1, T2, Ty, Txy = sums[:, np.searchsorted(x_sorted, psi, side='right')]  # sums over x > psi
+
+    A = np.empty((n_fits, k + 2, k + 2))
+    b = np.empty((n_fits, k + 2))
+    A[:, 0, 0] = sums[0, 0]
+    A[:, 0, 1] = A[:, 1, 0] = sums[1, 0]
+    A[:, 1, 1] = sums[2, 0]
+    A[:, 0, 2:] = A[:, 2:, 0] = T1 - psi * T0
+    A[:, 1, 2:] = A[:, 2:, 1] = T2 - psi * T1
+    for i in range(k):
+        for j in range(i, k):
+            # (x-psi_i)+ (x-psi_j)+ is only non-zero for x > psi_j
+            A[:, 2 + i, 2 + j] = A[:, 2 + j, 2 + i] = (T2[:, j] - (psi[:, i] + psi[:, j]) * T1[:, j]
+                                                       + psi[:, i] * psi[:, j] * T0[:, j])
+    b[:, 0] = sums[3, 0]
+    b[:, 1] = sums[4, 0]
+    b[:, 2:] = Txy - psi * Ty
+    if not inner_slope:
+        keep = [0] + list(range(2, k + 2))
+        A, b = A[:, keep][:, :, keep], b[:, keep]
+
+    try:
+        params = np.linalg.solve(A, b[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        params = np.einsum('fpq,fq->fp', np.linalg.pinv(A, hermitian=True), b)
+    rss = syy - np.sum(b * params, axis=1)
+    if not return_params:
+        return rss
+    if not inner_slope:
+        params = np.insert(params, 1, 0.0, axis=1)
+    return rss, params
+
+
+def _grid_search(x, y, w, k, bounds, min_gap, grid_size=None, chunk=100000, inner_slope=True, statistics=None):
+    """
+    Best k breakpoints among the midpoints between consecutive distinct x inside the allowed range, all
+    combinations that respect min_gap. grid_size thins the candidates for very large samples.
+    statistics reuses the output of _sufficient_statistics(x, y, w) (x and y are then not used).
+    Returns the breakpoints and their RSS, or (None, inf) when no combination is allowed.
+    """
+
+    x_sorted, sums, syy = _sufficient_statistics(x, y, w) if statistics is None else statistics
+    unique = np.unique(x_sorted)
+    candidates = (unique[1:] + unique[:-1]) / 2
+    candidates = candidates[(candidates > bounds[0]) & (candidates < bounds[1])]
+    if grid_size is not None and candidates.size > grid_size:
+        candidates = candidates[np.unique(np.linspace(0, candidates.size - 1, grid_size).round().astype(int))]
+    if candidates.size < k:
+        return None, np.inf
+
+    if k == 1:
+        combos = candidates[:, None]
+    elif k == 2:
+        i, j = np.triu_indices(candidates.size, 1)
+        combos = np.stack([candidates[i], candidates[j]], axis=1)
+    else:
+        combos = candidates[np.array(list(itertools.combinations(range(candidates.size), k)))]
+    if k > 1:
+        combos = combos[np.all(np.diff(combos, axis=1) > min_gap, axis=1)]
+
+    best, best_rss = None, np.inf
+    for start in range(0, len(combos), chunk):
+        rss = _grid_rss(x_sorted, sums, syy, combos[start:start + chunk], inner_slope)
+        if np.any(np.isfinite(rss)):
+            i = np.nanargmin(rss)
+            if rss[i] < best_rss:
+                best, best_rss = combos[start + i], rss[i]
+
+    if best is not None:
+        best, best_rss = _refine(x_sorted, sums, syy, unique, best.copy(), best_rss, bounds, min_gap,
+                                 inner_slope=inner_slope)
+    return best, best_rss
+
+
+def _refine(x_sorted, sums, syy, unique, psi, rss, bounds, min_gap, sweeps=3, points=21, zooms=4, inner_slope=True):
+    """
+    Moves each breakpoint inside the interval between the data points around it (where the RSS is smooth),
+    zooming on a grid of points, one breakpoint at a time.
+    """
+
+    k = psi.size
+    for _ in range(sweeps):
+        for j in range(k):
+            i = np.searchsorted(unique, psi[j])
+            lo, hi = max(unique[i - 1], bounds[0]), min(unique[i], bounds[1])
+            if j > 0:
+                lo = max(lo, psi[j - 1] + min_gap)
+            if j < k - 1:
+                hi = min(hi, psi[j + 1] - min_gap)
+            for _ in range(zooms):
+                if not hi > lo:
+                    break
+                trial = np.repeat(psi[None, :], points, axis=0)
+                trial[:, j] = np.linspace(lo, hi, points + 2)[1:-1]
+                trial_rss = _grid_rss(x_sorted, sums, syy, trial, inner_slope)
+                m = np.nanargmin(trial_rss)
+                if trial_rss[m] < rss:
+                    psi, rss = trial[m], trial_rss[m]
+                step = (hi - lo) / (points + 1)
+                lo, hi = max(lo, psi[j] - step), min(hi, psi[j] + step)
+    return psi, rss
+
+
+class BreakpointFit:
+    """
+    Continuous piecewise-linear fit with n breakpoints, with the interface of piecewise_regression.Fit used in this
+    package: get_results(), predict(), plot_fit() and plot_breakpoints().
+    The iterations start from the start values and from the least-squares breakpoints of the exhaustive search of
+    GridBreakpointFit (candidates thinned to grid_size), so the restarts begin from the global optimum whenever
+    the iterations converge there. The n_boot bootstrap resamples are drawn from a seeded generator and solved in
+    n_rounds stacked batches, each one restarting half of its resamples from the best fit so far.
+    """
+
+    def __init__(self, x, y, n_breakpoints=None, start_values=None, n_boot=200,
+                 min_distance_between_breakpoints=0.01, min_distance_to_edge=0.02,
+                 max_iterations=30, tolerance=1e-5, seed=None, n_rounds=2, grid_size=None):
+
+        self.xx = np.asarray(x, dtype=float)
+        self.yy = np.asarray(y, dtype=float)
+        if start_values is None and n_breakpoints is None:
+            raise ValueError("Fit algorithm requires either start_values or n_breakpoints")
+        self.n_breakpoints = len(start_values) if start_values is not None else n_breakpoints
+        k = self.n_breakpoints
+
+        rng = np.random.default_rng(seed)
+        bounds = (np.quantile(self.xx, min_distance_to_edge), np.quantile(self.xx, 1 - min_distance_to_edge))
+        min_gap = min_distance_between_breakpoints * np.ptp(self.xx)
+        options = (bounds, min_gap, max_iterations, tolerance)
+
+        def draw_starts(size):
+            # User start values, or random ones inside the allowed range (one draw per restart)
+            if start_values is not None:
+                return np.repeat(np.sort(np.asarray(start_values, dtype=float))[None, :], size, axis=0)
+            return np.sort(rng.uniform(bounds[0], bounds[1], size=(size, k)), axis=1)
+
+        self.start_values = draw_starts(1)[0]
+
+        # --- Initial fits, in one stack: from the start values and from the exhaustive grid optimum
+        grid, _ = _grid_search(self.xx, self.yy, np.ones_like(self.xx), k, bounds, min_gap, grid_size)
+        starts = self.start_values[None, :] if grid is None else np.stack([self.start_values, grid])
+        current, nxt, rss, converged = _muggeo_batch(self.xx, self.yy, None, starts, *options)
+        candidates = [(current, rss, converged)]
+        best_next, best_rss = None, np.inf
+        if converged.any():
+            i = np.flatnonzero(converged)[np.argmin(rss[converged])]
+            best_next, best_rss = nxt[i], rss[i]
+
+        # --- Bootstrap restarting, in n_rounds batches: each resample starts, with probability 1/2, from the best
+        # converged fit of the previous rounds, otherwise from the start values
+        n = self.xx.size
+        for block in np.array_split(np.arange(n_boot), max(1, min(n_rounds, n_boot))):
+            if block.size == 0:
+                continue
+            counts = rng.multinomial(n, np.full(n, 1.0 / n), size=block.size).astype(float)
+            starts = draw_starts(block.size)
+            from_best = rng.uniform(size=block.size) < 0.5
+            if best_next is not None:
+                starts[from_best] = best_next
+
+            current, nxt, rss, converged = _restart_batch(self.xx, self.yy, counts, starts, *options)
+            candidates.append((current, rss, converged))
+            if converged.any() and rss[converged].min() < best_rss:
+                i = np.flatnonzero(converged)[np.argmin(rss[converged])]
+                best_next, best_rss = nxt[i], rss[i]
+
+        current = np.concatenate([c[0] for c in candidates])
+        rss = np.concatenate([c[1] for c in candidates])
+        converged = np.concatenate([c[2] for c in candidates])
+
+        self.converged = bool(converged.any())
+        self.estimates = None
+        self.rss = None
+        self.bic = None
+        self.breakpoints = None
+        self.params = None
+        if self.converged:
+            best = np.flatnonzero(converged)[np.argmin(rss[converged])]
+            self._final_fit(current[best])
+
+    def _final_fit(self, psi, update=True):
+        """
+        OLS at the linearisation point of the best fit: estimates, standard errors and 95% confidence intervals.
+        With update the breakpoints are moved by one Muggeo step, as in piecewise_regression; without, psi is kept.
+        """
+
+        import scipy.stats
+
+        x, y, k = self.xx, self.yy, self.n_breakpoints
+        Z = _design(x, psi[None, :])[0]
+        pinv = np.linalg.pinv(Z)
+        params = pinv @ y
+        dof = x.size - 2 - 2 * k
+        cov = np.sum((y - Z @ params)**2) / dof * (pinv @ pinv.T)
+
+        gamma = params[2 + k:]
+        if update:
+            breakpoints = psi - gamma / params[2:2 + k]
+        else:
+            # --- Estimates of the model with its breakpoints at psi; standard errors from the linearisation
+            breakpoints = psi
+            params = np.concatenate([np.linalg.lstsq(Z[:, :2 + k], y, rcond=None)[0], gamma])
+        beta = params[2:2 + k]
+
+        estimates = {"const": {"estimate": params[0], "se": np.sqrt(cov[0, 0])}}
+        for j in range(k):
+            b, g = 2 + j, 2 + k + j
+            ratio = gamma[j] / beta[j]
+            bp_var = (cov[g, g] + cov[b, b] * ratio**2 - 2 * ratio * cov[b, g]) / beta[j]**2
+            estimates["beta{}".format(j + 1)] = {"estimate": beta[j], "se": np.sqrt(cov[b, b])}
+            estimates["breakpoint{}".format(j + 1)] = {"estimate": breakpoints[j], "se": np.sqrt(bp_var)}
+        for j in range(k + 1):
+            estimates["alpha{}".format(j + 1)] = {"estimate": np.sum(params[1:j + 2]),
+                                                 "se": np.sqrt(np.sum(cov[1:j + 2, 1:j + 2]))}
+
+        t_const = scipy.stats.t.ppf(0.975, dof)
+        for name, details in estimates.items():
+            details["confidence_interval"] = (details["estimate"] - t_const * details["se"],
+                                              details["estimate"] + t_const * details["se"])
+            if "breakpoint" in name:
+                details["t_stat"] = details["p_t"] = "-"
+            else:
+                details["t_stat"] = details["estimate"] / details["se"]
+                details["p_t"] = "-" if "beta" in name else scipy.stats.t.sf(np.abs(details["t_stat"]), dof) * 2
+
+        self.params = params[:2 + k]
+        self.breakpoints = breakpoints
+        self.estimates = estimates
+        self.rss = np.sum((y - self.predict(x))**2)
+        self.bic = x.size * np.log(self.rss / x.size) + (2 + 2 * k) * np.log(x.size)
+
+    def get_results(self):
+        return {"estimates": self.estimates, "rss": self.rss, "bic": self.bic, "converged": self.converged}
+
+    def predict(self, xx):
+        xx = np.asarray(xx, dtype=float)
+        return _predict(xx, self.params[None, :], self.breakpoints[None, :])[0]
+
+    def plot_fit(self, **kwargs):
+        import matplotlib.pyplot as plt
+        if self.converged:
+            xx = np.linspace(min(self.xx), max(self.xx), 100)
+            plt.plot(xx, self.predict(xx), **kwargs)
+
+    def plot_breakpoints(self, **kwargs):
+        import matplotlib.pyplot as plt
+        if self.converged:
+            for bp in self.breakpoints:
+                plt.axvline(bp, **kwargs)
+
+
+class GridBreakpointFit(BreakpointFit):
+    """
+    Best continuous piecewise-linear fit with n breakpoints by exhaustive search: every allowed combination of
+    breakpoints between consecutive data points is scored from prefix-sum statistics (O(n) candidates for one
+    breakpoint, O(n^2) for two), then refined inside the intervals between data points. No bootstrap and no
+    start values are needed, and the fit converges whenever the constraints leave any allowed combination.
+    """
+
+    def __init__(self, x, y, n_breakpoints=None, start_values=None,
+                 min_distance_between_breakpoints=0.01, min_distance_to_edge=0.02, grid_size=None):
+
+        self.xx = np.asarray(x, dtype=float)
+        self.yy = np.asarray(y, dtype=float)
+        if start_values is None and n_breakpoints is None:
+            raise ValueError("Fit algorithm requires either start_values or n_breakpoints")
+        self.n_breakpoints = len(start_values) if start_values is not None else n_breakpoints
+        self.start_values = None
+
+        bounds = (np.quantile(self.xx, min_distance_to_edge), np.quantile(self.xx, 1 - min_distance_to_edge))
+        min_gap = min_distance_between_breakpoints * np.ptp(self.xx)
+        w = np.ones_like(self.xx)
+
+        psi, rss = _grid_search(self.xx, self.yy, w, self.n_breakpoints, bounds, min_gap, grid_size)
+
+        self.converged = psi is not None
+        self.estimates = None
+        self.rss = None
+        self.bic = None
+        self.breakpoints = None
+        self.params = None
+        if self.converged:
+            self._final_fit(psi, update=False)
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+import numpy as np
+
+# --- Puts between two scans of the directory, to account for the entries written by other processes
+SCAN_EVERY = 100
+
+
+class FitCache:
+    """
+    On-disk cache of models.fit_models results: one pickle file per entry in a directory, named by a hash of the
+    fitted (x, y, ey) arrays and the fit settings. When the directory grows past max_bytes the least recently used
+    entries are removed. Safe to share between the processes of a batch run.
+    The size of the directory is tracked from the entries this process writes, and the directory is only scanned
+    when that total passes max_bytes or every SCAN_EVERY puts (for the entries of the other processes).
+    """
+
+    def __init__(self, path='fit_cache', max_bytes=2**30):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+        self._total = None
+        self._puts = 0
+
+    @staticmethod
+    def key(x, y, ey, **settings):
+        """
+        Content hash of the fitted arrays and the settings that change the fit (engine, n_boot, seed, ...).
+        """
+
+        digest = hashlib.sha256()
+        for array in (x, y, ey):
+            array = np.ascontiguousarray(array, dtype=np.float64)
+            digest.update(str(array.shape).encode())
+            digest.update(array.tobytes())
+        digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.pkl')
+
+    def get(self, key):
+        """
+        Returns the cached result, or None if there is none.
+        """
+
+        try:
+            with open(self._file(key), 'rb') as file:
+                result = pickle.load(file)
+            os.utime(self._file(key))  # mark as recently used
+            return result
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def put(self, key, result):
+        """
+        Stores a result (written to a temporary file and renamed, so readers never see partial entries).
+        """
+
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+                written = file.tell()
+            os.replace(tmp, self._file(key))
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+        self._puts += 1
+        if self._total is None or self._puts % SCAN_EVERY == 0:
+            self._total = self.size()
+        else:
+            self._total += written
+        if self._total > self.max_bytes:
+            self.evict()
+
+    def invalidate(self, key):
+        """
+        Removes one entry.
+        """
+
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """
+        Removes every entry.
+        """
+
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.pkl'):
+                self.invalidate(entry.name[:-4])
+
+    def size(self):
+        """
+        Total size of the entries in bytes.
+        """
+
+        total = 0
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.pkl'):
+                try:
+                    total += entry.stat().st_size
+                except FileNotFoundError:  # removed by another process
+                    continue
+        return total
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits in max_bytes. Returns the size left.
+        """
+
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.pkl'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:  # removed by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.name[:-4]))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.invalidate(key)
+            total -= size
+        self._total = total
+        return total
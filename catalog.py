@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+# --- Columns of the flux_elines tables used by the pipeline
+FLUX_COLUMNS = ['HIIREGID', 'RA', 'DEC', 'EWHa6562',
+                'fluxHb4861', 'e_fluxHb4861', 'fluxOIII5006', 'e_fluxOIII5006',
+                'fluxHa6562', 'e_fluxHa6562', 'fluxNII6583', 'e_fluxNII6583',
+                'fluxSII6716', 'e_fluxSII6716', 'fluxSII6730', 'e_fluxSII6730']
+
+
+def flux_dtypes(flux_dtype=np.float64):
+    """
+    Explicit dtypes for FLUX_COLUMNS. Coordinates are always float64 (offsets of arcseconds from the center);
+    EW and fluxes use flux_dtype (float32 halves the memory of a galaxy).
+    """
+
+    dtypes = {column: flux_dtype for column in FLUX_COLUMNS}
+    dtypes.update({'HIIREGID': str, 'RA': np.float64, 'DEC': np.float64})
+    return dtypes
+
+
+def galaxy_names(HIIREGID):
+    """
+    Galaxy name of each region from HIIREGID = '<galaxy>-<region number>'.
+    """
+
+    return pd.Series(HIIREGID).str.rsplit('-', n=1).str[0].to_numpy()
+
+
+def _columns(chunks):
+    table = pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+    return {column: table[column].to_numpy() for column in FLUX_COLUMNS}
+
+
+def iter_galaxies(path, chunksize=100000, flux_dtype=np.float64):
+    """
+    Streams a flux_elines catalog of many galaxies (HIIREGID prefixed by the galaxy name) in chunks of rows.
+    Yields (name, columns) per galaxy, columns being a dict {column: numpy array} of FLUX_COLUMNS.
+    The rows of a galaxy must be contiguous in the catalog; only one galaxy is held in memory at a time.
+    """
+
+    reader = pd.read_csv(path, usecols=FLUX_COLUMNS, dtype=flux_dtypes(flux_dtype), chunksize=chunksize)
+
+    current = None
+    pending = []
+    done = set()
+
+    for chunk in reader:
+        names = galaxy_names(chunk['HIIREGID'])
+        starts = np.concatenate([[0], np.flatnonzero(names[1:] != names[:-1]) + 1, [len(chunk)]])
+
+        for start, stop in zip(starts[:-1], starts[1:]):
+            name = names[start]
+            if name != current:
+                if current is not None:
+                    yield current, _columns(pending)
+                    done.add(current)
+                if name in done:
+                    raise ValueError(f"Rows of galaxy '{name}' are not contiguous in {path}.")
+                current = name
+                pending = []
+            pending.append(chunk.iloc[start:stop])
+
+    if current is not None:
+        yield current, _columns(pending)
@@ -0,0 +1,113 @@
+import contextlib
+import os
+import re
+
+import numpy as np
+
+from catalog import FLUX_COLUMNS
+
+## Spaxel mode: gradients from the spaxels of IFU emission-line maps instead of tabulated HII regions. A cube holds
+## one (ny, nx) plane per flux_elines column, stored as .npy or FITS and memory-mapped; only the planes the pipeline
+## uses are read, one at a time, and only the valid spaxels are gathered, so a galaxy never costs a whole cube in RAM.
+## RA/DEC of each spaxel come from the grid (FITS CRVAL/CRPIX/CDELT or a pixel scale around the galaxy center).
+
+# --- Default order of the planes of a cube: the flux_elines columns after HIIREGID, RA and DEC
+CUBE_PLANES = {column: plane for plane, column in enumerate(FLUX_COLUMNS[3:])}
+
+CUBE_FILE = re.compile(r'^flux_elines\.(?P<name>.+)\.cube\.(npy|fits|fits\.gz)$')
+
+# --- Spaxels whose Halpha or Hbeta flux is not positive (or NaN) never give an abundance and are not gathered
+REQUIRED_POSITIVE = ['fluxHa6562', 'fluxHb4861']
+
+
+@contextlib.contextmanager
+def open_cube(path, hdu=0):
+    """
+    Memory-maps a cube file: .npy with numpy, FITS with astropy (optional dependency). Use as
+    `with open_cube(path) as (data, header):`, data being a read-only (planes, ny, nx) array, only valid inside the
+    block (the FITS file stays open until then), and header the FITS header (None for .npy). Compressed FITS
+    (.fits.gz) cannot be memory-mapped and is decompressed on read.
+    """
+
+    if path.endswith('.npy'):
+        yield np.load(path, mmap_mode='r'), None
+        return
+
+    try:
+        from astropy.io import fits
+    except ImportError:
+        raise ImportError("Reading FITS cubes requires astropy; use .npy cubes or install astropy.") from None
+    with fits.open(path, memmap=True) as hdul:
+        yield hdul[hdu].data, hdul[hdu].header
+
+
+def spaxel_coordinates(index, shape, ra0, dec0, header=None, crpix=None, scale=1.0):
+    """
+    RA/DEC (degrees) of the spaxels at flat indices index of a (ny, nx) map. With a FITS header, the linear grid
+    CRVAL/CRPIX/CDELT (or CD) of its first two axes is used; otherwise pixel crpix (1-based (x, y), default the center
+    of the map) is at (ra0, dec0) with scale arcsec per spaxel, RA increasing to the left.
+    """
+
+    ny, nx = shape
+    y, x = np.divmod(np.asarray(index), nx)
+    x = x + 1.0
+    y = y + 1.0
+
+    if header is not None:
+        ra_ref, dec_ref = header['CRVAL1'], header['CRVAL2']
+        x_ref, y_ref = header['CRPIX1'], header['CRPIX2']
+        dra = header.get('CDELT1', header.get('CD1_1'))
+        ddec = header.get('CDELT2', header.get('CD2_2'))
+    else:
+        ra_ref, dec_ref = ra0, dec0
+        x_ref, y_ref = ((nx + 1)/2, (ny + 1)/2) if crpix is None else crpix
+        dra, ddec = -scale/3600, scale/3600
+
+    dec = dec_ref + (y - y_ref)*ddec
+    ra = ra_ref + (x - x_ref)*dra/np.cos(dec*np.pi/180)
+    return ra, dec
+
+
+def _gather(data, planes, flux_dtype):
+    """
+    Columns of the valid spaxels of a (planes, ny, nx) array (see spaxel_columns), their flat indices and the map
+    shape. The columns are copies, so they outlive the file of the cube.
+    """
+
+    shape = data.shape[1:]
+
+    # --- One plane in memory at a time; NaN in the other lines is left to the quality masks of abundance, so a
+    # --- spaxel without SII still gives its O3N2/N2 abundances
+    valid = np.ones(shape, dtype=bool)
+    for column in REQUIRED_POSITIVE:
+        valid &= data[planes[column]] > 0
+    index = np.flatnonzero(valid)
+
+    columns = {column: np.array(data[plane].reshape(-1)[index], dtype=flux_dtype) for column, plane in planes.items()}
+    return columns, index, shape
+
+
+def spaxel_columns(path, params, planes=None, flux_dtype=np.float64, hdu=0, crpix=None, scale=1.0):
+    """
+    The valid spaxels of a cube as a flux_elines table: a dict {column: array} of catalog.FLUX_COLUMNS, like a
+    galaxy of catalog.iter_galaxies, with HIIREGID '<galaxy>-<flat spaxel index>'. params is the row of the galaxy
+    table (galaxy, ra0, dec0 are used for the grid, see spaxel_coordinates). planes maps the columns to plane
+    numbers (default CUBE_PLANES). A spaxel is valid when its Halpha and Hbeta fluxes are positive; the other planes
+    may be NaN, and abundance.corrected_lines leaves those spaxels out of the calibrators that need the line.
+    """
+
+    planes = CUBE_PLANES if planes is None else planes
+    if isinstance(path, str):
+        with open_cube(path, hdu) as (data, header):
+            columns, index, shape = _gather(data, planes, flux_dtype)
+    else:
+        header = None
+        columns, index, shape = _gather(path, planes, flux_dtype)
+
+    columns['RA'], columns['DEC'] = spaxel_coordinates(index, shape, params['ra0'], params['dec0'], header, crpix, scale)
+    columns['HIIREGID'] = np.array(['{}-{}'.format(params['galaxy'], i) for i in index], dtype=object)
+    return {column: columns[column] for column in FLUX_COLUMNS}
+
+
+def is_cube(path):
+    return isinstance(path, str) and CUBE_FILE.match(os.path.basename(path)) is not None
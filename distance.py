@@ -30,3 +30,106 @@ def distances(ra, ra0, dec, dec0, pa, ba, d, re):
     r = np.sqrt(r1**2 + r2**2) * d_kpc / re
     
     return r
+
+
+## Deprojected radii of the regions of many galaxies in one call
+
+DEG = np.pi/180
+
+_kernel = None
+
+
+def galaxy_geometry(ra0, dec0, pa, ba, d, re):
+    """
+    Per-galaxy terms of distances() (arrays, one entry per galaxy): center in radians, sin/cos of the PA,
+    cos(i) and the radius scale d_kpc/re.
+    """
+
+    ra0 = np.asarray(ra0, dtype=np.float64)*DEG
+    dec0 = np.asarray(dec0, dtype=np.float64)*DEG
+    pa = np.asarray(pa, dtype=np.float64)*DEG
+    ba = np.asarray(ba, dtype=np.float64)
+    cos_i = np.sqrt((ba**2-0.13**2)/(1-0.13**2))
+    scale = np.asarray(d, dtype=np.float64) * 1e3 / np.asarray(re, dtype=np.float64)
+    return ra0, dec0, np.sin(pa), np.cos(pa), cos_i, scale
+
+
+def _numba_kernel():
+    global _kernel
+    if _kernel is None:
+        import numba
+
+        @numba.njit(parallel=True, cache=True)
+        def kernel(ra, dec, galaxy, ra0, dec0, sin_pa, cos_pa, cos_i, scale, r):
+            for i in numba.prange(ra.shape[0]):
+                g = galaxy[i]
+                dra = ra[i]*DEG - ra0[g]
+                ddec = dec[i]*DEG - dec0[g]
+                cos_dec = np.cos(dec[i]*DEG)
+                r1 = -dra*sin_pa[g]*cos_dec + ddec*cos_pa[g]
+                r2 = (-dra*cos_pa[g]*cos_dec - ddec*sin_pa[g])/cos_i[g]
+                r[i] = np.sqrt(r1**2 + r2**2) * scale[g]
+
+        _kernel = kernel
+    return _kernel
+
+
+def distances_stacked(ra, dec, galaxy, ra0, dec0, pa, ba, d, re, dtype=np.float64, jit=False, chunk=2**20):
+    """
+    distances() for a stacked table of regions (or spaxels) of many galaxies. ra, dec and galaxy are per-region
+    arrays, galaxy being the row of each region in the per-galaxy arrays ra0, dec0, pa, ba, d, re (e.g. the
+    columns of the galaxy table). The galaxy terms are computed once and gathered per region; the NumPy path works
+    in chunks of reused buffers. dtype sets the output type (float32 halves the memory; the arithmetic is always
+    float64). jit=True uses a compiled parallel loop and requires Numba.
+    """
+
+    ra = np.asarray(ra, dtype=np.float64)
+    dec = np.asarray(dec, dtype=np.float64)
+    galaxy = np.asarray(galaxy, dtype=np.intp)
+    geometry = galaxy_geometry(ra0, dec0, pa, ba, d, re)
+    r = np.empty(len(ra), dtype=dtype)
+
+    if jit:
+        if dtype == np.float64:
+            _numba_kernel()(ra, dec, galaxy, *geometry, r)
+        else:
+            r64 = np.empty(len(ra), dtype=np.float64)
+            _numba_kernel()(ra, dec, galaxy, *geometry, r64)
+            r[:] = r64
+        return r
+
+    size = min(chunk, len(ra))
+    dra, ddec, cos_dec, r1, r2 = (np.empty(size) for _ in range(5))
+    for start in range(0, len(ra), chunk):
+        stop = min(start + chunk, len(ra))
+        n = stop - start
+        g = galaxy[start:stop]
+        ra0_g, dec0_g, sin_pa, cos_pa, cos_i, scale = (term[g] for term in geometry)
+        a, b, c, p, q = dra[:n], ddec[:n], cos_dec[:n], r1[:n], r2[:n]
+
+        np.multiply(ra[start:stop], DEG, out=a)
+        a -= ra0_g
+        np.multiply(dec[start:stop], DEG, out=b)
+        np.cos(b, out=c)
+        b -= dec0_g
+        np.multiply(a, c, out=a)  # (ra-ra0)*cos(dec)
+
+        # --- r1 = -(ra-ra0)*sin(pa)*cos(dec) + (dec-dec0)*cos(pa)
+        np.multiply(b, cos_pa, out=p)
+        np.multiply(a, sin_pa, out=q)
+        p -= q
+        # --- r2 = (-(ra-ra0)*cos(pa)*cos(dec) - (dec-dec0)*sin(pa))/cos(i)
+        np.multiply(a, cos_pa, out=q)
+        np.negative(q, out=q)
+        b *= sin_pa
+        q -= b
+        q /= cos_i
+
+        np.square(p, out=p)
+        np.square(q, out=q)
+        p += q
+        np.sqrt(p, out=p)
+        p *= scale
+        r[start:stop] = p
+
+    return r
@@ -1,3 +1,4 @@
+import batch
 import fit_OH
 import pandas as pd
 
@@ -44,6 +45,8 @@ show_graph = True
 
 ###############################################################################
 
-results = fit_OH.fit_final(name, HIIREGID, ra, ra0, dec, dec0, pa, ba, d, re, EWHa, Hb4861, eHb4861, Ha6562, eHa6562, OIII5006, eOIII5006, NII6583, eNII6583, SII6716, eSII6716, SII6730, eSII6730, calibrator, criterion, save_table, save_graph, show_graph)
+output = fit_OH.fit_final(name, HIIREGID, ra, ra0, dec, dec0, pa, ba, d, re, EWHa, Hb4861, eHb4861, Ha6562, eHa6562, OIII5006, eOIII5006, NII6583, eNII6583, SII6716, eSII6716, SII6730, eSII6730, calibrator, criterion, save_table, save_graph, show_graph)
 
-print(results)
\ No newline at end of file
+# --- The parameters of the best model, as in the batch summary table (output also holds the figure data and the
+# --- FitResult under 'figure' and 'result')
+print({key: output[key] for key in ['galaxy'] + batch.PARAMS})
@@ -1,23 +1,120 @@
+import os
+
+import numpy as np
+
 import distance
 import abundance
 import criteria
-import models
-import plot
+import profiling
+from binning import radial_bins
 
-def fit_final(name, HIIREGID, ra, ra0, dec, dec0, pa, ba, d, re, EWHa, Hb4861, eHb4861, Ha6562, eHa6562, OIII5006, eOIII5006, NII6583, eNII6583, SII6716, eSII6716, SII6730, eSII6730, calibrator, criterion, save_table, save_graph, show_graph):
+# --- models (statsmodels, piecewise_regression) and plot (matplotlib) are imported by the stages that use them,
+# --- so that abundances and filtered tables do not pay for their import
 
-    x = distance.distances(ra, ra0, dec, dec0, pa, ba, d, re)
-    
-    y, ey, Ha6562_cor, OIII5006_cor, NII6583_cor = abundance.abundance(name, x, HIIREGID, EWHa, Hb4861, eHb4861, Ha6562, eHa6562, OIII5006, eOIII5006, NII6583, eNII6583, SII6716, eSII6716, SII6730, eSII6730, calibrator)
-    
-    r, oh, eoh = criteria.points(name, criterion, x, y, ey, EWHa, Ha6562_cor, OIII5006_cor, NII6583_cor, calibrator, save_table)
-    
-    results_dict = models.fit_models(r, oh, eoh)
-
-    if results_dict is not None:
-        output = plot.plot_model(results_dict, name, criterion, calibrator, save_graph, show_graph)
-        print(f"{name} Completed!")  # this will be displayed
-        return output
+def fit_final(name, HIIREGID, ra, ra0, dec, dec0, pa, ba, d, re, EWHa, Hb4861, eHb4861, Ha6562, eHa6562, OIII5006, eOIII5006, NII6583, eNII6583, SII6716, eSII6716, SII6730, eSII6730, calibrator, criterion, save_table, save_graph, show_graph,
+              engine='piecewise_regression', n_boot=200, seed=None, cache=None, sink=None, profile=False, profile_dir=None,
+              binning=None, select_models=None, profile_memory=False):
+    """
+    Fits the abundance gradient of one galaxy. binning (a dict of options of binning.radial_bins, e.g.
+    {'mode': 'count', 'n_bins': 50}) bins the selected points in radius before the fits; the output then holds the
+    number of raw points of each fitted bin under 'bin_counts'. select_models (True, or a dict of candidates of
+    selection.model_table) scores the candidate models: the parameters and figure are then those of the lowest-AIC
+    model of the table (named under 'best_model'), the table is added under 'model_table' and 'result' keeps the
+    three models of models.fit_models. With profile, returns (output, record), record being the
+    profiling.Profile record of the run (time per stage, region counts, convergence); profile_dir
+    also dumps cProfile statistics to <profile_dir>/<name>.prof. profile_memory adds the tracemalloc peak memory of
+    each stage, in a run that is then several times slower: use it in a separate pass from the timings.
+    """
+
+    if profile:
+        profiler = profiling.Profile(name, memory=profile_memory, cprofile_path=None if profile_dir is None else os.path.join(profile_dir, str(name) + '.prof'))
     else:
-        print(f"Insufficient data for fitting the galaxy {name}.")
-        return None
+        profiler = profiling.NoProfile()
+
+    with profiler:
+        with profiler.stage('distance'):
+            x = distance.distances(ra, ra0, dec, dec0, pa, ba, d, re)
+        profiler.count('regions', len(x))
+
+        with profiler.stage('abundance'):
+            y, ey, Ha6562_cor, OIII5006_cor, NII6583_cor = abundance.abundance(name, x, HIIREGID, EWHa, Hb4861, eHb4861, Ha6562, eHa6562, OIII5006, eOIII5006, NII6583, eNII6583, SII6716, eSII6716, SII6730, eSII6730, calibrator, sink)
+        profiler.count('abundance', np.isfinite(y).sum())
+
+        with profiler.stage('criteria'):
+            r, oh, eoh = criteria.points(name, criterion, x, y, ey, EWHa, Ha6562_cor, OIII5006_cor, NII6583_cor, calibrator, save_table, sink)
+        profiler.count('criteria', len(r))
+
+        if binning is not None:
+            with profiler.stage('binning'):
+                r, oh, eoh, counts = radial_bins(r, oh, eoh, **binning)
+            profiler.count('binned', len(r))
+
+        with profiler.stage('models'):
+            import models
+            fit_result = models.fit_models(r, oh, eoh, engine=engine, n_boot=n_boot, seed=seed, cache=cache, profile=profiler)
+
+        if fit_result is not None:
+            import plot
+            data = None
+            if select_models:
+                with profiler.stage('selection'):
+                    import selection
+                    table = selection.model_table(r, oh, eoh, None if select_models is True else select_models)
+                    data = selection.figure_data(table.iloc[0], plot.figure_data(fit_result, name, criterion, calibrator))
+            with profiler.stage('plot'):
+                output = plot.plot_model(fit_result, name, criterion, calibrator, save_graph, show_graph, data)
+            if binning is not None:
+                output['bin_counts'] = counts
+            if select_models:
+                output['best_model'] = table['model'].iloc[0]
+                output['model_table'] = table
+            print(f"{name} Completed!")  # this will be displayed
+        else:
+            print(f"Insufficient data for fitting the galaxy {name}.")
+            output = None
+
+    if profile:
+        return output, profiler.record
+    return output
+
+
+CRITERIONS = [None, 'ST06', 'KA03', 'KE01', 'KE6A', 'CF11']
+
+def fit_sweep(name, HIIREGID, ra, ra0, dec, dec0, pa, ba, d, re, EWHa, Hb4861, eHb4861, Ha6562, eHa6562, OIII5006, eOIII5006, NII6583, eNII6583, SII6716, eSII6716, SII6730, eSII6730, calibrators, criterions, save_table, save_graph, show_graph,
+              engine='piecewise_regression', n_boot=200, seed=None, cache=None, sink=None):
+    """
+    Runs fit_final for every calibrator/criterion combination of one galaxy.
+    Distances and extinction correction are computed once, and identical point sets are fitted only once.
+    Returns a dict {(calibrator, criterion): output of fit_final}.
+    """
+
+    x = distance.distances(ra, ra0, dec, dec0, pa, ba, d, re)
+
+    columns, masks = abundance.corrected_lines(Hb4861, eHb4861, Ha6562, eHa6562, OIII5006, eOIII5006, NII6583, eNII6583,
+                                               SII6716, eSII6716, SII6730, eSII6730)
+    abundance.save_table(name, x, HIIREGID, EWHa, columns, sink)
+
+    fits = {}
+    outputs = {}
+    for calibrator in calibrators:
+        y, ey = abundance.calibrated(columns, masks, calibrator)
+
+        for criterion in criterions:
+            r, oh, eoh = criteria.points(name, criterion, x, y, ey, EWHa, columns['Ha6562_cor'], columns['OIII5006_cor'],
+                                         columns['NII6583_cor'], calibrator, save_table, sink)
+
+            key = (r.tobytes(), oh.tobytes(), eoh.tobytes())
+            if key not in fits:
+                import models
+                fits[key] = models.fit_models(r, oh, eoh, engine=engine, n_boot=n_boot, seed=seed, cache=cache)
+            fit_result = fits[key]
+
+            if fit_result is not None:
+                import plot
+                outputs[(calibrator, criterion)] = plot.plot_model(fit_result, name, criterion, calibrator, save_graph, show_graph)
+            else:
+                print(f"Insufficient data for fitting the galaxy {name} ({abundance.CALIBRATORS[calibrator]}, {criterion}).")
+                outputs[(calibrator, criterion)] = None
+
+    print(f"{name} Completed! {len(fits)} distinct fits for {len(outputs)} combinations.")
+    return outputs
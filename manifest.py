@@ -0,0 +1,121 @@
+import datetime
+import hashlib
+import json
+import sqlite3
+
+import numpy as np
+
+## Run manifest of batch runs: one SQLite row per galaxy/calibrator/criterion with the fingerprint of its inputs and
+## settings, its status and its summary row, written as soon as each fit finishes. A rerun skips the combinations
+## that are done with the same fingerprint and refits only new, failed or changed ones. The rows come back from the
+## workers after the tables of their galaxy are written (see batch._fit_columns): a galaxy is only recorded as done
+## once its outputs are on disk, and a failed write is recorded as an error, to be redone.
+
+# --- Statuses that are not redone when the fingerprint is unchanged
+DONE = ('ok', 'insufficient')
+
+
+def file_digest(path, block=2**20):
+    """
+    SHA-256 of the content of a file.
+    """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(block), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def columns_digest(columns):
+    """
+    SHA-256 of a dict of column arrays (e.g. a galaxy from catalog.iter_galaxies).
+    """
+
+    digest = hashlib.sha256()
+    for name in sorted(columns):
+        array = np.asarray(columns[name])
+        digest.update(name.encode())
+        if array.dtype.kind == 'O' or array.dtype.kind == 'U':
+            digest.update('\n'.join(map(str, array)).encode())
+        else:
+            digest.update(str(array.dtype).encode())
+            digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def fingerprint(data_digest, **settings):
+    """
+    Fingerprint of one fit: the digest of its input data and the settings that change its result.
+    """
+
+    text = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.sha256((data_digest + text).encode()).hexdigest()
+
+
+class Manifest:
+    """
+    SQLite manifest of a batch run (see batch.fit_survey). Only the parent process writes to it, and every record is
+    committed at once, so a killed run loses at most the fits in progress.
+    """
+
+    def __init__(self, path='manifest.sqlite'):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS fits ('
+                                'galaxy TEXT, calibrator INTEGER, criterion TEXT, fingerprint TEXT, status TEXT, '
+                                'row TEXT, updated TEXT, PRIMARY KEY (galaxy, calibrator, criterion))')
+        self.connection.commit()
+
+    @staticmethod
+    def _key(galaxy, calibrator, criterion):
+        return str(galaxy), int(calibrator), str(criterion)
+
+    def done(self, galaxy, calibrator, criterion, fingerprint):
+        """
+        The stored summary row if this combination finished (status in DONE) with the same fingerprint, else None.
+        """
+
+        found = self.connection.execute('SELECT fingerprint, status, row FROM fits '
+                                        'WHERE galaxy = ? AND calibrator = ? AND criterion = ?',
+                                        self._key(galaxy, calibrator, criterion)).fetchone()
+        if found is None or found[0] != fingerprint or found[1] not in DONE:
+            return None
+        return json.loads(found[2])
+
+    def record(self, galaxy, calibrator, criterion, fingerprint, row):
+        """
+        Stores (or replaces) the result of a combination and commits.
+        """
+
+        row = {key: value for key, value in row.items() if key not in ('profile', 'figure')}
+        self.connection.execute('INSERT OR REPLACE INTO fits VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                self._key(galaxy, calibrator, criterion) +
+                                (fingerprint, row['status'], json.dumps(row, default=float),
+                                 datetime.datetime.now().isoformat(timespec='seconds')))
+        self.connection.commit()
+
+    def rows(self, status=None):
+        """
+        Stored summary rows, optionally only those with a given status.
+        """
+
+        query = 'SELECT row FROM fits' + (' WHERE status = ?' if status is not None else '')
+        return [json.loads(row) for row, in self.connection.execute(query, () if status is None else (status,))]
+
+    def counts(self):
+        """
+        Number of combinations per status.
+        """
+
+        return dict(self.connection.execute('SELECT status, COUNT(*) FROM fits GROUP BY status').fetchall())
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
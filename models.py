@@ -1,8 +1,57 @@
-import statsmodels.api as sm
-import piecewise_regression
+import contextlib
+
 import numpy as np
+import breakpoints
+import profiling
+import results
+import selection
+
+# --- Settings of the 1 and 2 breakpoint fits
+FIT2 = dict(n_breakpoints=1, min_distance_to_edge=0.05)
+FIT3 = dict(n_breakpoints=2, min_distance_between_breakpoints=0.20, min_distance_to_edge=0.05, start_values=[0.5, 1.5])
+
+# --- Minimum number of points to fit a galaxy (also used by binning and montecarlo)
+MIN_POINTS = 10
+
+
+@contextlib.contextmanager
+def _seeded(seed):
+    """
+    piecewise_regression draws from the global NumPy generator and takes no generator of its own: seed it for the
+    fits, then restore the state it had, so the caller's random stream is left as it was.
+    """
+
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        yield
+    finally:
+        np.random.set_state(state)
 
-def fit_models(x_array, y_array, ey_array):
+
+def _grid_options(engine, settings):
+    """
+    Exhaustive searches of the native and grid engines keep at most selection.GRID_SIZE breakpoint candidates, as
+    model_table does, so the 2-breakpoint search of a dense galaxy is not quadratic in its number of points.
+    """
+
+    if engine == 'piecewise_regression':
+        return {}
+    return {'grid_size': selection.GRID_SIZE.get(settings['n_breakpoints'])}
+
+
+def fit_models(x_array, y_array, ey_array, engine='piecewise_regression', n_boot=200, seed=None, cache=None, profile=None):
+    """
+    Fits a straight line and piecewise-linear models with 1 and 2 breakpoints and selects the best one by AIC.
+    engine='piecewise_regression' uses piecewise_regression.Fit; engine='native' uses breakpoints.BreakpointFit,
+    which starts from the exhaustive-search optimum and solves the n_boot bootstrap restarts in a few stacked batches
+    from a seeded generator;
+    engine='grid' uses breakpoints.GridBreakpointFit, an exhaustive search that needs no bootstrap or start values.
+    cache is an optional cache.FitCache: results are looked up by the fitted arrays and the fit settings.
+    profile is an optional profiling.Profile that times the three fits and records their convergence.
+    Returns a results.FitResult (estimates, errors, RSS and AIC of the three models, no Fit objects), or None with
+    fewer than MIN_POINTS points.
+    """
 
     x = np.array(x_array)
     y = np.array(y_array)
@@ -14,64 +63,100 @@ def fit_models(x_array, y_array, ey_array):
     y = y[mask]
     ey = ey[mask]
     
-    if len(x) >= 10:
+    if profile is None:
+        profile = profiling.NoProfile()
+    profile.count('fitted', len(x))
+
+    # --- statsmodels and piecewise_regression are slow to import: only load them when a fit runs
+    with profile.stage('models.import'):
+        import statsmodels.api as sm
+        if engine == 'piecewise_regression':
+            import piecewise_regression
+
+    if engine == 'piecewise_regression':
+        Fit = piecewise_regression.main.Fit
+        options = {'n_boot': n_boot}
+    elif engine == 'native':
+        Fit = breakpoints.BreakpointFit
+        options = {'n_boot': n_boot, 'seed': seed}
+    elif engine == 'grid':
+        Fit = breakpoints.GridBreakpointFit
+        options = {}
+    else:
+        raise ValueError("Invalid engine. Use 'piecewise_regression', 'native' or 'grid'.")
+
+    if len(x) >= MIN_POINTS:
+
+        if cache is not None:
+            key = cache.key(x, y, ey, engine=engine, n_boot=n_boot, seed=seed, fit2=FIT2, fit3=FIT3,
+                            grid_size=selection.GRID_SIZE, result='FitResult')
+            cached = cache.get(key)
+            if cached is not None:
+                profile.count('cache_hit', 1)
+                return cached
     
         # CASE 1 fit: simple linear regression
-        X = sm.add_constant(x)
-        model = sm.OLS(y, X)
-        results = model.fit()
-        a2 = results.params[1]
-        ea2 = results.bse[1]
-        b0 = results.params[0]
-        eb0 = results.bse[0]
-        RSS1 = results.ssr
+        with profile.stage('models.ols'):
+            X = sm.add_constant(x)
+            model = sm.OLS(y, X)
+            ols = model.fit()
+        a2 = ols.params[1]
+        ea2 = ols.bse[1]
+        b0 = ols.params[0]
+        eb0 = ols.bse[0]
+        RSS1 = ols.ssr
         
-        # CASE 2 fit: 1 breakpoint
-        fit2 = piecewise_regression.main.Fit(x, y, n_boot=200, n_breakpoints=1, min_distance_to_edge=0.05)
-        RSS2 = fit2.get_results()["rss"] if fit2.get_results()["converged"] else 1e6
-        
-        # CASE 3 fit: 2 breakpoints
-        fit3 = piecewise_regression.main.Fit(x, y, n_boot=200, n_breakpoints=2, 
-                                             min_distance_between_breakpoints=0.20, min_distance_to_edge=0.05,
-                                             start_values=[0.5, 1.5])
-        RSS3 = fit3.get_results()["rss"] if fit3.get_results()["converged"] else 1e6
-
-        # Functions for AIC
-        def llf_(X, rss):
-            nobs = float(X.shape[0])
-            llf = -0.5 * nobs * (np.log(2*np.pi) + np.log(rss/nobs) + 1)
-            return llf
-            
-        def aic_(X, rss, param):
-            llf = llf_(X, rss)
-            return -2*llf + 2*param
-        
-        def aic_c(X, rss, param):
-            llf = llf_(X, rss)
-            return -2*llf + 2*param + (2*param*(param+1))/(len(X)-param-1)
-            
-        def aic_final(X, RSS, param):
-            nobs = float(X.shape[0])
-            if nobs/param >= 40:
-                AIC = aic_(X, RSS, param)
-            else:
-                AIC = aic_c(X, RSS, param)
-            return AIC
-            
-        AIC1 = aic_final(x, RSS1, 2)
-        AIC2 = aic_final(x, RSS2, 4)
-        AIC3 = aic_final(x, RSS3, 6)
+        seeding = _seeded(seed) if engine == 'piecewise_regression' and seed is not None else contextlib.nullcontext()
+        with seeding:
+            # CASE 2 fit: 1 breakpoint
+            with profile.stage('models.fit2'):
+                fit2 = Fit(x, y, **FIT2, **options, **_grid_options(engine, FIT2))
+            results2 = fit2.get_results()
+
+            # CASE 3 fit: 2 breakpoints
+            with profile.stage('models.fit3'):
+                fit3 = Fit(x, y, **FIT3, **options, **_grid_options(engine, FIT3))
+        profile.converged('fit2', results2["converged"])
+        RSS2 = results2["rss"] if results2["converged"] else 1e6
+
+        results3 = fit3.get_results()
+        profile.converged('fit3', results3["converged"])
+        RSS3 = results3["rss"] if results3["converged"] else 1e6
+
+        n = len(x)
+        AIC1 = selection.aic(n, selection.log_likelihood(n, RSS1), 2)
+        AIC2 = selection.aic(n, selection.log_likelihood(n, RSS2), 4)
+        AIC3 = selection.aic(n, selection.log_likelihood(n, RSS3), 6)
 
         # Selection of the best model
         AICs = [AIC1, AIC2, AIC3]
         best_case = np.argmin(AICs) + 1
 
-        return {
-            'x': x, 'y': y, 'ey': ey,
-            'best_case': best_case,
-            'fit1': (a2, ea2, b0, eb0, RSS1),
-            'fit2': fit2,
-            'fit3': fit3,
-            'AICs': AICs
-        }
+        # Compact result: estimates only, the Fit objects (and their bootstrap history) are dropped
+        record = results.empty_record()
+        record['n_points'] = len(x)
+        record['best_case'] = best_case
+        for case, (AIC, RSS, fit_results) in enumerate(zip(AICs, [RSS1, RSS2, RSS3], [None, results2, results3]), 1):
+            record['aic{}'.format(case)] = AIC
+            converged = fit_results is None or fit_results["converged"]
+            record['converged{}'.format(case)] = converged
+            if converged:
+                record['rss{}'.format(case)] = RSS
+            if fit_results is not None and converged:
+                for name, details in fit_results["estimates"].items():
+                    if name.startswith('beta'):
+                        continue
+                    field = 'fit{}_{}'.format(case, name)
+                    record[field], record[field + '_se'] = details["estimate"], details["se"]
+                    if name.startswith('breakpoint'):
+                        record[field + '_lo'], record[field + '_hi'] = details["confidence_interval"]
+        record['fit1_const'], record['fit1_const_se'] = b0, eb0
+        record['fit1_alpha1'], record['fit1_alpha1_se'] = a2, ea2
+
+        fit = results.FitResult(x, y, ey, record)
+
+        if cache is not None:
+            cache.put(key, fit)
+
+        return fit
 
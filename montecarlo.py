@@ -0,0 +1,246 @@
+import warnings
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+import distance
+import abundance
+import criteria
+import breakpoints
+from models import FIT2, FIT3, MIN_POINTS
+
+## Monte Carlo propagation of the flux errors to the abundances and the gradient parameters.
+## Each realization draws every flux from a normal distribution of its e_flux, and the whole (realizations x regions)
+## array goes through the extinction correction, the calibrator and the criterion at once. The gradients of all the
+## realizations are then refitted together: the points a realization leaves out get zero weight, so every fit
+## shares the same x and the Muggeo iterations of a chunk of realizations are solved in one stacked call.
+
+# --- Criteria that use the [OIII]/Hb ratio (BPT diagram)
+BPT_CRITERIA = ['ST06', 'KA03', 'KE01', 'KE6A']
+
+
+def _lines(calibrator, criterion):
+    """
+    Lines drawn for a calibrator and criterion: Hb, Ha and NII always, OIII for O3N2 and BPT criteria, SII for D16.
+    """
+
+    lines = ['Hb4861', 'Ha6562', 'NII6583']
+    if calibrator in [1, 3] or criterion in BPT_CRITERIA:
+        lines.append('OIII5006')
+    if calibrator == 5:
+        lines += ['SII6716', 'SII6730']
+    return lines
+
+
+def _fit(x, y, w, psi):
+    """
+    Weighted least-squares continuous piecewise-linear fits with the breakpoints fixed at psi (fits, k), k >= 0.
+    Returns the (const, alpha1, betas) parameters and the weighted RSS.
+    """
+
+    k = psi.shape[1]
+    Z = breakpoints._design(x, psi)[..., :2 + k]
+    ZtZ = np.einsum('fnp,fn,fnq->fpq', Z, w, Z)
+    Zty = np.einsum('fnp,fn,fn->fp', Z, w, y)
+    try:
+        params = np.linalg.solve(ZtZ, Zty[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        params = np.einsum('fpq,fq->fp', np.linalg.pinv(ZtZ, hermitian=True), Zty)
+    rss = np.sum(w * (y - breakpoints._predict(x, params, psi))**2, axis=1)
+    return params, rss
+
+
+def _realizations(x, EWHa, flux, calibrator, criterion, size, seed, nominal, n_starts, weighted,
+                  max_iterations, tolerance):
+    """
+    One chunk of realizations: draws the fluxes, selects the points and fits the line and the 1 and 2 breakpoint
+    models of every realization. nominal holds the breakpoints of the nominal fits (or None), used as start values.
+    """
+
+    rng = np.random.default_rng(seed)
+    n = x.size
+
+    # --- Flux realizations (size x regions); the errors and the quality masks use the catalog errors
+    draws = {}
+    for line in _lines(calibrator, criterion):
+        value, error = flux['flux' + line], flux['e_flux' + line]
+        draws['flux' + line] = value + error * rng.standard_normal((size, n))
+        draws['e_flux' + line] = error
+
+    out = abundance.abundance_kernel(draws, calibrators=[calibrator], lines=['OIII5006'] if 'fluxOIII5006' in draws else ())
+    name = abundance.CALIBRATORS[calibrator]
+    good = out['mask_' + name]
+    oh = np.where(good, out['OH_' + name], np.nan)
+    eoh = np.where(good, np.abs(out['eOH_' + name]), np.nan)
+    OIII5006_cor = out.get('OIII5006_cor', np.full((size, n), np.nan))
+    selected = criteria.mask(criterion, oh, eoh, EWHa, out['Ha6562_cor'], OIII5006_cor, out['NII6583_cor'])
+    selected &= np.isfinite(x)
+
+    n_points = selected.sum(axis=1)
+    fitted = n_points >= MIN_POINTS
+    y = np.where(selected, oh, 0.0)
+    w = selected.astype(float)
+    if weighted:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            w = np.where(selected & (eoh > 0), 1 / eoh**2, 0.0)
+
+    results = {'n_points': n_points, 'regions': {'OH': oh, 'eOH': eoh, 'selected': selected}}
+
+    # --- Straight line
+    params, rss = np.full((size, 2), np.nan), np.full(size, np.nan)
+    if fitted.any():
+        params[fitted], rss[fitted] = _fit(x, y[fitted], w[fitted], np.empty((fitted.sum(), 0)))
+    results['fit1'] = {'const': params[:, 0], 'alpha1': params[:, 1], 'rss': rss}
+
+    # --- Allowed breakpoint range of each realization, from its selected points
+    xs = np.where(selected, x, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # realizations without selected points
+        span = np.nanmax(xs, axis=1) - np.nanmin(xs, axis=1)
+
+    for key, settings in (('fit2', FIT2), ('fit3', FIT3)):
+        k = settings['n_breakpoints']
+        edge = settings.get('min_distance_to_edge', 0.02)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            lower, upper = np.nanquantile(xs, [edge, 1 - edge], axis=1)
+        min_gap = settings.get('min_distance_between_breakpoints', 0.01) * span
+
+        # --- Start values: the nominal breakpoints, the settings' start values and random ones, n_starts per
+        # realization, all solved in one stack
+        starts = rng.uniform(lower[:, None, None], upper[:, None, None], size=(size, n_starts, k))
+        fixed = [psi for psi in (nominal[key], settings.get('start_values')) if psi is not None]
+        for i, psi in enumerate(fixed[:n_starts]):
+            starts[:, i] = psi
+        starts = np.sort(starts, axis=2).reshape(size * n_starts, k)
+
+        def repeat(array):
+            return np.repeat(array, n_starts, axis=0)
+
+        _, psi, rss, converged = breakpoints._muggeo_batch(x, repeat(y), repeat(w), starts,
+                                                           (repeat(lower), repeat(upper)), repeat(min_gap),
+                                                           max_iterations, tolerance)
+        rss = np.where(converged, rss, np.inf).reshape(size, n_starts)
+        best = np.argmin(rss, axis=1)
+        psi = psi.reshape(size, n_starts, k)[np.arange(size), best]
+        converged = np.isfinite(rss[np.arange(size), best]) & fitted
+
+        params, rss = np.full((size, 2 + k), np.nan), np.full(size, np.nan)
+        if converged.any():
+            params[converged], rss[converged] = _fit(x, y[converged], w[converged], psi[converged])
+        psi[~converged] = np.nan
+        alphas = np.cumsum(params[:, 1:], axis=1)
+        fit = {'const': params[:, 0]}
+        fit.update({'alpha{}'.format(j + 1): alphas[:, j] for j in range(k + 1)})
+        fit.update({'breakpoint{}'.format(j + 1): psi[:, j] for j in range(k)})
+        fit.update({'rss': rss, 'converged': converged})
+        results[key] = fit
+
+    return results
+
+
+def region_statistics(oh, eoh, selected, percentiles=(16, 50, 84)):
+    """
+    Per-region statistics of (realizations x regions) OH and eOH over the realizations in which the region has an
+    abundance: mean, std and percentiles of OH, mean eOH, n (number of such realizations) and the fraction of
+    realizations that select the region. Regions without any abundance are NaN.
+    """
+
+    n = np.sum(np.isfinite(oh), axis=0)
+    stats = {'n': n, 'selected': np.mean(selected, axis=0)}
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # regions without abundances
+        stats['OH_mean'] = np.nanmean(oh, axis=0)
+        stats['OH_std'] = np.where(n > 1, np.nanstd(oh, axis=0, ddof=1), np.where(n == 1, 0.0, np.nan))
+        for p, values in zip(percentiles, np.nanpercentile(oh, percentiles, axis=0)):
+            stats['OH_p{}'.format(p)] = values
+        stats['eOH_mean'] = np.nanmean(eoh, axis=0)
+    return stats
+
+
+def monte_carlo(ra, ra0, dec, dec0, pa, ba, d, re, EWHa, Hb4861, eHb4861, Ha6562, eHa6562, OIII5006, eOIII5006,
+                NII6583, eNII6583, SII6716, eSII6716, SII6730, eSII6730, calibrator, criterion,
+                n_realizations=1000, seed=None, n_jobs=1, chunk=100, n_starts=4, weighted=False,
+                max_iterations=30, tolerance=1e-5, percentiles=(16, 50, 84), keep_realizations=False):
+    """
+    Gradient parameters of n_realizations flux realizations of one galaxy (same inputs as fit_OH.fit_final).
+    Realizations are processed in chunks of chunk, over n_jobs processes; each chunk has its own seed derived from
+    seed, so the results do not depend on n_jobs. weighted=True weights the points by 1/eOH^2.
+    Returns a dict with n_points (selected points per realization) and, for 'fit1' (line), 'fit2' and 'fit3' (1 and
+    2 breakpoints, settings of models.FIT2/FIT3), arrays of const, alpha1.., breakpoint1.., rss (and converged).
+    Realizations with fewer than MIN_POINTS points or that did not converge are NaN. 'regions' holds the
+    region_statistics of the OH realizations of every region (arrays in the order of the inputs), with percentiles;
+    keep_realizations adds the (realizations x regions) arrays OH, eOH and selected under 'realizations'.
+    """
+
+    if calibrator not in abundance.CALIBRATORS:
+        raise ValueError("Invalid calibrator. Use 1=O3N2_PP04, 2=N2_PP04, 3=O3N2_M13, 4=N2_M13, 5=D16.")
+
+    x = np.asarray(distance.distances(ra, ra0, dec, dec0, pa, ba, d, re), dtype=float)
+    EWHa = np.asarray(EWHa, dtype=float)
+    values = {'Hb4861': (Hb4861, eHb4861), 'Ha6562': (Ha6562, eHa6562), 'OIII5006': (OIII5006, eOIII5006),
+              'NII6583': (NII6583, eNII6583), 'SII6716': (SII6716, eSII6716), 'SII6730': (SII6730, eSII6730)}
+    flux = {}
+    for line, (value, error) in values.items():
+        flux['flux' + line] = np.asarray(value, dtype=float)
+        flux['e_flux' + line] = np.asarray(error, dtype=float)
+
+    # --- Nominal fits, for the start values of the realizations
+    columns, masks = abundance.corrected_lines(*(flux[prefix + line] for line in values for prefix in ('flux', 'e_flux')))
+    oh, eoh = abundance.calibrated(columns, masks, calibrator)
+    selected = criteria.mask(criterion, oh, eoh, EWHa, columns['Ha6562_cor'], columns['OIII5006_cor'],
+                             columns['NII6583_cor']) & np.isfinite(x)
+    nominal = {'fit2': None, 'fit3': None}
+    if selected.sum() >= MIN_POINTS:
+        for key, settings in (('fit2', FIT2), ('fit3', FIT3)):
+            settings = {name: value for name, value in settings.items() if name != 'start_values'}
+            psi, _ = breakpoints._grid_search(x[selected], oh[selected], np.ones(selected.sum()),
+                                              settings['n_breakpoints'],
+                                              tuple(np.quantile(x[selected], [settings['min_distance_to_edge'],
+                                                                              1 - settings['min_distance_to_edge']])),
+                                              settings.get('min_distance_between_breakpoints', 0.01)
+                                              * np.ptp(x[selected]))
+            nominal[key] = psi
+
+    sizes = [size for size in np.diff(np.r_[np.arange(0, n_realizations, chunk), n_realizations]) if size]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = [(x, EWHa, flux, calibrator, criterion, size, chunk_seed, nominal, n_starts, weighted,
+             max_iterations, tolerance) for size, chunk_seed in zip(sizes, seeds)]
+
+    if n_jobs > 1 and len(args) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            parts = list(executor.map(_realizations, *zip(*args)))
+    else:
+        parts = [_realizations(*a) for a in args]
+
+    results = {'n_points': np.concatenate([part['n_points'] for part in parts])}
+    regions = {name: np.concatenate([part['regions'][name] for part in parts]) for name in ('OH', 'eOH', 'selected')}
+    results['regions'] = region_statistics(regions['OH'], regions['eOH'], regions['selected'], percentiles)
+    if keep_realizations:
+        results['realizations'] = regions
+    for key in ('fit1', 'fit2', 'fit3'):
+        results[key] = {name: np.concatenate([part[key][name] for part in parts]) for name in parts[0][key]}
+    return results
+
+
+def summary(results, percentiles=(16, 50, 84)):
+    """
+    Mean, standard deviation and percentiles of every parameter over the realizations that were fitted.
+    Returns {fit: {parameter: {'mean', 'std', 'p16', ...}}}.
+    """
+
+    table = {}
+    for key in ('fit1', 'fit2', 'fit3'):
+        table[key] = {}
+        for name, values in results[key].items():
+            if name == 'converged':
+                table[key][name] = float(np.mean(values))
+                continue
+            values = values[np.isfinite(values)]
+            stats = {'mean': np.nan, 'std': np.nan}
+            stats.update({'p{}'.format(p): np.nan for p in percentiles})
+            if values.size:
+                stats['mean'], stats['std'] = np.mean(values), np.std(values, ddof=1) if values.size > 1 else 0.0
+                stats.update({'p{}'.format(p): v for p, v in zip(percentiles, np.percentile(values, percentiles))})
+            table[key][name] = stats
+    return table
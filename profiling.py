@@ -0,0 +1,144 @@
+import contextlib
+import cProfile
+import os
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+## Per-stage instrumentation of the pipeline: wall time, CPU time and peak memory of each stage, region counts
+## and fit convergence, in one plain dict per galaxy (picklable, so it travels back from the batch workers).
+
+
+class Profile:
+    """
+    Records the stages of one fit. Use `with profile.stage('name'):` around each stage; stages can be nested
+    (e.g. 'models' and 'models.fit2'). memory=True traces allocations with tracemalloc (Python and NumPy), which
+    slows the run down; cprofile_path dumps cProfile statistics of the whole run to that file.
+    """
+
+    def __init__(self, name=None, memory=True, cprofile_path=None):
+        self.record = {'galaxy': name, 'stages': {}, 'counts': {}, 'converged': {}}
+        self.memory = memory
+        self.cprofile_path = cprofile_path
+        self._stack = []
+        self._profiler = None
+        self._tracing = False
+
+    def __enter__(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        if self.cprofile_path is not None:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self._profiler is not None:
+            self._profiler.disable()
+            folder = os.path.dirname(self.cprofile_path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            self._profiler.dump_stats(self.cprofile_path)
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Times the enclosed block. Peak memory is the largest traced allocation above the memory at the start.
+        """
+
+        tracing = self.memory and tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+        frame = {'start': current if tracing else 0, 'peak': current if tracing else 0}
+        self._stack.append(frame)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            self._stack.pop()
+            peak_bytes = np.nan
+            if tracing:
+                frame['peak'] = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                peak_bytes = frame['peak'] - frame['start']
+                if self._stack:
+                    self._stack[-1]['peak'] = max(self._stack[-1]['peak'], frame['peak'])
+                tracemalloc.reset_peak()
+            stages = self.record['stages']
+            previous = stages.get(name, {'wall': 0.0, 'cpu': 0.0, 'peak_bytes': np.nan, 'calls': 0})
+            stages[name] = {'wall': previous['wall'] + wall, 'cpu': previous['cpu'] + cpu,
+                            'peak_bytes': np.fmax(previous['peak_bytes'], peak_bytes), 'calls': previous['calls'] + 1}
+
+    def count(self, name, value):
+        """
+        Records a number of regions (e.g. surviving a mask).
+        """
+
+        self.record['counts'][name] = int(value)
+
+    def converged(self, name, value):
+        """
+        Records the convergence status of a fit.
+        """
+
+        self.record['converged'][name] = bool(value)
+
+
+class NoProfile:
+    """
+    Stand-in for Profile when profiling is off: every call does nothing.
+    """
+
+    record = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        yield
+
+    def count(self, name, value):
+        pass
+
+    def converged(self, name, value):
+        pass
+
+
+def aggregate(records, percentiles=(50, 95)):
+    """
+    Per-stage statistics of the records of a batch run: count and percentiles (default p50, p95) of the wall time,
+    CPU time and peak memory of each stage. Returns a DataFrame with one row per stage.
+    """
+
+    values = {}
+    for record in records:
+        if not record:
+            continue
+        for stage, stats in record['stages'].items():
+            for key in ('wall', 'cpu', 'peak_bytes'):
+                values.setdefault(stage, {}).setdefault(key, []).append(stats[key])
+
+    rows = []
+    for stage, stats in values.items():
+        row = {'stage': stage, 'n': len(stats['wall'])}
+        for key, samples in stats.items():
+            samples = np.asarray(samples, dtype=float)
+            for p in percentiles:
+                row['{}_p{}'.format(key, p)] = np.nanpercentile(samples, p) if np.isfinite(samples).any() else np.nan
+        rows.append(row)
+
+    columns = ['stage', 'n'] + ['{}_p{}'.format(key, p) for key in ('wall', 'cpu', 'peak_bytes') for p in percentiles]
+    return pd.DataFrame(rows, columns=columns)
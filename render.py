@@ -0,0 +1,195 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from abundance import CALIBRATORS
+
+## Rendering of the gradient figures from their numeric content (plot.figure_data), apart from the fits: figures can be
+## drawn later, in their own process pool, into PNG files, one multi-page PDF or contact sheets. A FigureTemplate
+## builds the figure and its artists once; each galaxy only updates their data.
+
+def _pyplot():
+    # --- Files only: default to the non-interactive Agg backend, unless pyplot is already loaded
+    if 'matplotlib.pyplot' not in sys.modules:
+        import matplotlib
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def file_name(data):
+    """
+    <name>_<criterion>_<calibrator> of a figure, as written by plot.plot_model.
+    """
+
+    if data['calibrator'] not in CALIBRATORS:
+        raise ValueError("Invalid calibrator. Use 1=O3N2_PP04, 2=N2_PP04, 3=O3N2_M13, 4=N2_M13, 5=D16.")
+    return str(data['galaxy']) + "_" + str(data['criterion']) + "_" + CALIBRATORS[data['calibrator']]
+
+
+class FigureTemplate:
+    """
+    The gradient figure of plot.plot_model, built once: points with error bars, model, breakpoints and their
+    confidence intervals. update(data) redraws it for another galaxy by changing the data of the artists.
+    With ax, the template draws in an existing axes (e.g. a panel of a contact sheet); compact drops the axis labels.
+    """
+
+    def __init__(self, ax=None, compact=False):
+        plt = _pyplot()
+        from matplotlib.collections import LineCollection
+
+        if ax is None:
+            self.fig, ax = plt.subplots()
+        else:
+            self.fig = ax.figure
+        self.ax = ax
+
+        self.errors = LineCollection([], colors='black', linewidths=0.5, zorder=1)
+        ax.add_collection(self.errors)
+        self.caps, = ax.plot([], [], linestyle='none', marker='_', ms=3 if compact else 6, color='black', zorder=1)
+        self.points, = ax.plot([], [], linestyle='none', marker='o', markerfacecolor='mediumslateblue',
+                               markeredgecolor='black', ms=3 if compact else 5, zorder=1)
+        self.curve, = ax.plot([], [], color='red', linewidth=1.5 if compact else 2, zorder=3)
+        self.lines = []
+        self.boxes = []
+
+        if compact:
+            self.title = ax.set_title('', size=7)
+            ax.tick_params(labelsize=6)
+        else:
+            self.title = ax.set_title('')
+            ax.set_xlabel("$r$/r$_e$", size=14)
+            ax.set_ylabel("12+log(O/H)", size=14)
+        ax.minorticks_on()
+        ax.tick_params(which='major', direction='in', length=4.0, width=0.7, colors='black', grid_color='gray', grid_alpha=0.9)
+        ax.tick_params(which='minor', direction='in', length=2.0, width=0.5, colors='black', grid_color='gray', grid_alpha=0.9)
+
+    def _breakpoint_artists(self, n):
+        import matplotlib.pyplot as plt
+        while len(self.lines) < n:
+            self.lines.append(self.ax.axvline(0, linewidth=0.8, color='gray', linestyle='-.', zorder=2))
+            self.boxes.append(self.ax.add_patch(plt.Rectangle((0, 0), 0, 0, facecolor="azure", zorder=0.5)))
+
+    def update(self, data):
+        """
+        Draws the figure of one fit (a dict from plot.figure_data).
+        """
+
+        x, y, ey = data['x'], data['y'], data['ey']
+        ymin, ymax = 0.97*min(y), 1.03*max(y)
+
+        self.errors.set_segments(np.stack([np.stack([x, y - ey], axis=1), np.stack([x, y + ey], axis=1)], axis=1))
+        self.caps.set_data(np.concatenate([x, x]), np.concatenate([y - ey, y + ey]))
+        self.points.set_data(x, y)
+        self.curve.set_data(*data['curve'])
+
+        self._breakpoint_artists(len(data['breakpoints']))
+        for j, (line, box) in enumerate(zip(self.lines, self.boxes)):
+            visible = j < len(data['breakpoints'])
+            line.set_visible(visible)
+            box.set_visible(visible)
+            if visible:
+                line.set_xdata([data['breakpoints'][j]] * 2)
+                lower, upper = data['intervals'][j]
+                box.set_bounds(lower, ymin, upper - lower, ymax - ymin)
+
+        self.title.set_text(str(data['galaxy']))
+        self.ax.set_xlim([0, max(x)*1.05])
+        self.ax.set_ylim([ymin, ymax])
+        self.ax.set_visible(True)
+
+    def save(self, path):
+        self.fig.savefig(path, transparent=False, facecolor='w', edgecolor='w')
+
+    def close(self):
+        _pyplot().close(self.fig)
+
+
+def _render_pngs(figures, folder):
+    os.makedirs(folder, exist_ok=True)
+    template = FigureTemplate()
+    files = []
+    try:
+        for data in figures:
+            template.update(data)
+            files.append(os.path.join(folder, file_name(data) + '.png'))
+            template.save(files[-1])
+    finally:
+        template.close()
+    return files
+
+
+def _render_pdf(figures, path):
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    template = FigureTemplate()
+    try:
+        with PdfPages(path) as pdf:
+            for data in figures:
+                template.update(data)
+                pdf.savefig(template.fig, facecolor='w', edgecolor='w')
+    finally:
+        template.close()
+    return [path]
+
+
+def _render_sheets(figures, path, columns, rows):
+    plt = _pyplot()
+    per_page = columns * rows
+    fig, axes = plt.subplots(rows, columns, figsize=(2.2*columns, 1.8*rows), squeeze=False)
+    templates = [FigureTemplate(ax, compact=True) for ax in axes.ravel()]
+
+    files = []
+    pdf = None
+    if path.endswith('.pdf'):
+        from matplotlib.backends.backend_pdf import PdfPages
+        pdf = PdfPages(path)
+        files.append(path)
+    try:
+        for page, start in enumerate(range(0, len(figures), per_page)):
+            page_figures = figures[start:start + per_page]
+            for template, data in zip(templates, page_figures):
+                template.update(data)
+            for template in templates[len(page_figures):]:
+                template.ax.set_visible(False)
+            if page == 0:
+                fig.tight_layout()  # once the titles and tick labels are drawn
+            if pdf is not None:
+                pdf.savefig(fig, facecolor='w', edgecolor='w')
+            else:
+                files.append('{}_{:03d}.png'.format(path, page + 1))
+                fig.savefig(files[-1], facecolor='w', edgecolor='w')
+    finally:
+        if pdf is not None:
+            pdf.close()
+        plt.close(fig)
+    return files
+
+
+def render_many(figures, mode='png', path=None, n_jobs=1, columns=5, rows=4):
+    """
+    Renders a list of plot.figure_data dicts. mode 'png' writes <path>/<name>_<criterion>_<calibrator>.png
+    (path defaults to graphs), spread over n_jobs processes, each reusing one FigureTemplate; 'pdf' writes one page
+    per fit to the file path (default graphs.pdf); 'sheet' writes contact sheets of columns x rows panels per page,
+    to path if it ends with .pdf, else to <path>_001.png, ... (default contact_sheet.pdf).
+    Returns the list of files written.
+    """
+
+    figures = [data for data in figures if data is not None]
+    if mode == 'png':
+        path = path or 'graphs'
+        if n_jobs > 1 and len(figures) > 1:
+            chunks = [chunk for chunk in np.array_split(np.arange(len(figures)), n_jobs) if chunk.size]
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                parts = executor.map(_render_pngs, [[figures[i] for i in chunk] for chunk in chunks],
+                                     [path] * len(chunks))
+                return [file for part in parts for file in part]
+        return _render_pngs(figures, path)
+    elif mode == 'pdf':
+        return _render_pdf(figures, path or 'graphs.pdf')
+    elif mode == 'sheet':
+        return _render_sheets(figures, path or 'contact_sheet.pdf', columns, rows)
+    else:
+        raise ValueError("Invalid render mode. Use 'png', 'pdf' or 'sheet'.")
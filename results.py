@@ -0,0 +1,136 @@
+import numpy as np
+
+## Compact result of models.fit_models: the fitted points and one row of a NumPy structured array with the estimates,
+## standard errors and breakpoint confidence intervals of the three models, their RSS and AIC and the selected model.
+## No Fit objects are kept, so results are small to pickle and the rows of a survey stack into one array.
+
+# --- Number of breakpoints of the models 1 (line), 2 and 3
+BREAKPOINTS = {1: 0, 2: 1, 3: 2}
+
+
+def _dtype():
+    fields = [('n_points', np.int64), ('best_case', np.int8)]
+    fields += [('aic{}'.format(case), np.float64) for case in BREAKPOINTS]
+    fields += [('rss{}'.format(case), np.float64) for case in BREAKPOINTS]
+    fields += [('converged{}'.format(case), np.bool_) for case in BREAKPOINTS]
+    for case, k in BREAKPOINTS.items():
+        names = ['const'] + ['alpha{}'.format(j + 1) for j in range(k + 1)] + ['breakpoint{}'.format(j + 1) for j in range(k)]
+        for name in names:
+            fields += [('fit{}_{}'.format(case, name), np.float64), ('fit{}_{}_se'.format(case, name), np.float64)]
+        for j in range(k):
+            fields += [('fit{}_breakpoint{}_lo'.format(case, j + 1), np.float64),
+                       ('fit{}_breakpoint{}_hi'.format(case, j + 1), np.float64)]
+    return np.dtype(fields)
+
+
+RESULT_DTYPE = _dtype()
+
+
+class FitResult:
+    """
+    Result of models.fit_models: x, y, ey (the fitted points) and record, a row of RESULT_DTYPE.
+    Fields are fit<case>_<estimate> (const, alpha1.., breakpoint1..), with _se and, for breakpoints, the 95%
+    confidence interval _lo/_hi; aic<case>, rss<case>, converged<case>, best_case and n_points.
+    Estimates of models that did not converge are NaN.
+    """
+
+    __slots__ = ('x', 'y', 'ey', 'record')
+
+    def __init__(self, x, y, ey, record):
+        self.x = x
+        self.y = y
+        self.ey = ey
+        self.record = record
+
+    def __getstate__(self):
+        return self.x, self.y, self.ey, self.record
+
+    def __setstate__(self, state):
+        self.x, self.y, self.ey, self.record = state
+
+    @property
+    def best_case(self):
+        return int(self.record['best_case'])
+
+    @property
+    def aics(self):
+        return [float(self.record['aic{}'.format(case)]) for case in BREAKPOINTS]
+
+    def converged(self, case):
+        return bool(self.record['converged{}'.format(case)])
+
+    def estimate(self, case, name):
+        """
+        (estimate, se) of const, alpha<j> or breakpoint<j> of a model.
+        """
+
+        field = 'fit{}_{}'.format(case, name)
+        return float(self.record[field]), float(self.record[field + '_se'])
+
+    def breakpoints(self, case):
+        return [float(self.record['fit{}_breakpoint{}'.format(case, j + 1)]) for j in range(BREAKPOINTS[case])]
+
+    def intervals(self, case):
+        """
+        95% confidence intervals (lo, hi) of the breakpoints of a model.
+        """
+
+        return [(float(self.record['fit{}_breakpoint{}_lo'.format(case, j + 1)]),
+                 float(self.record['fit{}_breakpoint{}_hi'.format(case, j + 1)])) for j in range(BREAKPOINTS[case])]
+
+    def predict(self, xx, case=None):
+        """
+        Model values at xx, of the best model by default.
+        """
+
+        case = self.best_case if case is None else case
+        xx = np.asarray(xx, dtype=float)
+        alphas = [self.estimate(case, 'alpha{}'.format(j + 1))[0] for j in range(BREAKPOINTS[case] + 1)]
+        yy = self.estimate(case, 'const')[0] + alphas[0] * xx
+        for j, breakpoint in enumerate(self.breakpoints(case)):
+            yy = yy + (alphas[j + 1] - alphas[j]) * np.maximum(xx - breakpoint, 0)
+        return yy
+
+    def to_record(self):
+        return self.record
+
+
+# --- Estimates of the best model reported as b0, a1, h1, a2, h2, a3 (see best_parameters)
+REPORTED = {1: [('a2', 'alpha1')],
+            2: [('a1', 'alpha1'), ('h1', 'breakpoint1'), ('a2', 'alpha2')],
+            3: [('a1', 'alpha1'), ('h1', 'breakpoint1'), ('a2', 'alpha2'), ('h2', 'breakpoint2'), ('a3', 'alpha3')]}
+
+
+def best_parameters(record):
+    """
+    Parameters of the best model of a record as reported by plot.plot_model: b0, a1, h1, a2, h2, a3 and their
+    errors eb0, ea1, ... The slope of a line is a2; parameters the model does not have are 0.
+    """
+
+    fit = FitResult(None, None, None, record)
+    case = fit.best_case
+    params = dict.fromkeys(['b0', 'eb0', 'a1', 'ea1', 'h1', 'eh1', 'a2', 'ea2', 'h2', 'eh2', 'a3', 'ea3'], 0.0)
+    params['b0'], params['eb0'] = fit.estimate(case, 'const')
+    for key, name in REPORTED[case]:
+        params[key], params['e' + key] = fit.estimate(case, name)
+    return params
+
+
+def empty_record():
+    """
+    A RESULT_DTYPE row with NaN estimates, not converged.
+    """
+
+    record = np.zeros((), dtype=RESULT_DTYPE)
+    for name in RESULT_DTYPE.names:
+        if RESULT_DTYPE[name].kind == 'f':
+            record[name] = np.nan
+    return record
+
+
+def stack(results):
+    """
+    One structured array (RESULT_DTYPE) from FitResults; None (insufficient data) gives an empty row.
+    """
+
+    return np.array([empty_record() if result is None else result.record for result in results], dtype=RESULT_DTYPE)
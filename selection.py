@@ -0,0 +1,207 @@
+import numpy as np
+import pandas as pd
+
+import breakpoints
+
+## Model selection over more candidates than the three models of models.fit_models: lines and continuous
+## piecewise-linear models with 1 to 3 breakpoints, a flat inner plateau, each unweighted and weighted by 1/eOH^2.
+## The sorted radii and the suffix sums of breakpoints._sufficient_statistics are built once per weighting and shared
+## by every candidate: each one is an exhaustive breakpoint search on those sums, with no bootstrap, so adding a
+## model costs a search on the sums and not another pass of fits over the data. fit_OH.fit_final(select_models=...)
+## reports the parameters and figure of the best model of the table instead of those of models.fit_models.
+
+# --- Candidate models: number of breakpoints and, for plateau, a zero slope before the first breakpoint
+CANDIDATES = {'linear': dict(n_breakpoints=0),
+              'bp1': dict(n_breakpoints=1),
+              'bp2': dict(n_breakpoints=2),
+              'bp3': dict(n_breakpoints=3),
+              'plateau': dict(n_breakpoints=1, plateau=True)}
+
+# --- Constraints of the breakpoints (as models.FIT2 and models.FIT3), in quantiles of r and fractions of its range
+MIN_DISTANCE_TO_EDGE = 0.05
+MIN_DISTANCE_BETWEEN_BREAKPOINTS = 0.20
+
+# --- Breakpoint candidates kept per number of breakpoints before refining (all for 1 breakpoint); 400 keeps the
+# --- 2-breakpoint search of a galaxy with thousands of points to at most 80k pairs
+GRID_SIZE = {2: 400, 3: 80}
+
+
+def log_likelihood(n, rss, log_weights=0.0):
+    """
+    Gaussian log-likelihood of a least-squares fit of n points with residual sum of squares rss (weighted RSS for
+    weighted fits, log_weights being then the sum of the log of the weights).
+    """
+
+    return -0.5 * n * (np.log(2*np.pi) + np.log(rss/n) + 1) + 0.5 * log_weights
+
+
+def aic(n, llf, n_params):
+    """
+    AIC, or AICc when n/n_params < 40.
+    """
+
+    value = -2*llf + 2*n_params
+    if n / n_params < 40:
+        value += (2*n_params*(n_params+1))/(n-n_params-1)
+    return value
+
+
+def bic(n, llf, n_params):
+    return -2*llf + n_params*np.log(n)
+
+
+def akaike_weights(aics):
+    """
+    exp(-delta AIC/2), normalised; models without an AIC get a zero weight.
+    """
+
+    aics = np.asarray(aics, dtype=float)
+    weights = np.exp(-(aics - np.nanmin(aics))/2)
+    weights[~np.isfinite(weights)] = 0.0
+    return weights / np.sum(weights)
+
+
+def _errors(x, y, w, psi, plateau):
+    """
+    Standard errors of const, the slopes and the breakpoints of a model with its breakpoints at psi, and the 95%
+    confidence intervals of the breakpoints, from the linearisation of breakpoints.BreakpointFit._final_fit
+    (update=False).
+    """
+
+    import scipy.stats
+
+    k = psi.size
+    Z = breakpoints._design(x, psi[None, :])[0]
+    if plateau:
+        Z = np.delete(Z, 1, axis=1)
+    sw = np.sqrt(w)
+    pinv = np.linalg.pinv(Z * sw[:, None])
+    params = pinv @ (y * sw)
+    dof = x.size - Z.shape[1]
+    first = 1 if plateau else 2
+    cov = np.sum((y*sw - (Z * sw[:, None]) @ params)**2) / dof * (pinv @ pinv.T)
+
+    # --- Slope j is the sum of alpha1 (absent with a plateau) and the first betas
+    increments = ([] if plateau else [1]) + list(range(first, first + k))
+    slopes_se = []
+    for j in range(k + 1):
+        index = increments[:j + 1 - int(plateau)]
+        slopes_se.append(float(np.sqrt(np.sum(cov[np.ix_(index, index)]))))
+
+    t_const = scipy.stats.t.ppf(0.975, dof)
+    breakpoints_se, intervals = [], []
+    for j in range(k):
+        b, g = first + j, first + k + j
+        ratio = params[g] / params[b]
+        se = float(np.sqrt((cov[g, g] + cov[b, b] * ratio**2 - 2 * ratio * cov[b, g]) / params[b]**2))
+        breakpoints_se.append(se)
+        intervals.append((psi[j] - t_const * se, psi[j] + t_const * se))
+
+    return float(np.sqrt(cov[0, 0])), tuple(slopes_se), tuple(breakpoints_se), tuple(intervals)
+
+
+def model_table(x, y, ey=None, candidates=None, weighted=(False, True), grid_size=None):
+    """
+    Fits every candidate (default CANDIDATES, dicts of n_breakpoints and plateau) unweighted and/or weighted by
+    1/ey^2 (weighted, skipped without positive errors) and returns a DataFrame sorted by AIC with, per model: rss
+    (weighted for weighted fits), llf, n_params (2 + 2*breakpoints, one less with a plateau), aic (AICc for small
+    samples, as in models.fit_models), bic, delta_aic, delta_bic, the Akaike weight, the breakpoints, const and
+    the slopes of the segments, their standard errors (const_se, slopes_se, breakpoints_se) and the 95% confidence
+    intervals of the breakpoints. Models whose constraints leave no allowed breakpoints are reported as not converged.
+    """
+
+    candidates = CANDIDATES if candidates is None else candidates
+    grid_size = GRID_SIZE if grid_size is None else grid_size
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    ey = np.full_like(x, np.nan) if ey is None else np.asarray(ey, dtype=float)
+    mask = ~np.isnan(x) & ~np.isnan(y)
+    x, y, ey = x[mask], y[mask], ey[mask]
+    n = x.size
+
+    if not np.all(ey > 0):
+        weighted = [weights for weights in weighted if not weights]
+    bounds = (np.quantile(x, MIN_DISTANCE_TO_EDGE), np.quantile(x, 1 - MIN_DISTANCE_TO_EDGE))
+    min_gap = MIN_DISTANCE_BETWEEN_BREAKPOINTS * np.ptp(x)
+
+    # --- Shared statistics: sorted x and suffix sums, once per weighting
+    shared = {}
+    for weights in weighted:
+        w = 1/ey**2 if weights else np.ones_like(x)
+        shared[weights] = (breakpoints._sufficient_statistics(x, y, w), np.sum(w*y)/np.sum(w),
+                           np.sum(np.log(w)) if weights else 0.0, w)
+
+    rows = []
+    for name, spec in candidates.items():
+        k = spec['n_breakpoints']
+        plateau = spec.get('plateau', False)
+        n_params = 2 + 2*k - int(plateau)
+        for weights in weighted:
+            statistics, y_mean, log_weights, w = shared[weights]
+            row = {'model': name + ('_weighted' if weights else ''), 'n_breakpoints': k, 'plateau': plateau,
+                   'weighted': weights, 'n_params': n_params, 'converged': False, 'rss': np.nan, 'llf': np.nan,
+                   'aic': np.nan, 'bic': np.nan, 'breakpoints': (), 'const': np.nan, 'slopes': (),
+                   'const_se': np.nan, 'slopes_se': (), 'breakpoints_se': (), 'intervals': ()}
+
+            if k == 0:
+                psi = np.empty(0)
+            else:
+                psi, _ = breakpoints._grid_search(None, None, None, k, bounds, min_gap, grid_size.get(k),
+                                                  inner_slope=not plateau, statistics=statistics)
+            if psi is not None:
+                rss, params = breakpoints._grid_rss(*statistics, psi[None, :], inner_slope=not plateau,
+                                                    return_params=True)
+                rss, params = rss[0], params[0]
+                llf = log_likelihood(n, rss, log_weights)
+                row.update(converged=True, rss=rss, llf=llf, aic=aic(n, llf, n_params), bic=bic(n, llf, n_params),
+                           breakpoints=tuple(psi.tolist()), const=params[0] + y_mean,
+                           slopes=tuple(np.cumsum(params[1:]).tolist()))
+                const_se, slopes_se, breakpoints_se, intervals = _errors(x, y, w, psi, plateau)
+                row.update(const_se=const_se, slopes_se=slopes_se, breakpoints_se=breakpoints_se, intervals=intervals)
+            rows.append(row)
+
+    table = pd.DataFrame(rows)
+    table['delta_aic'] = table['aic'] - table['aic'].min()
+    table['delta_bic'] = table['bic'] - table['bic'].min()
+    table['weight'] = akaike_weights(table['aic'])
+    return table.sort_values('aic', kind='stable', na_position='last').reset_index(drop=True)
+
+
+def predict(row, xx):
+    """
+    Values at xx of a model of model_table.
+    """
+
+    xx = np.asarray(xx, dtype=float)
+    slopes = np.asarray(row['slopes'])
+    y = row['const'] + slopes[0] * xx
+    for j, psi in enumerate(row['breakpoints']):
+        y = y + (slopes[j + 1] - slopes[j]) * np.maximum(xx - psi, 0)
+    return y
+
+
+def best_parameters(row):
+    """
+    Parameters of a model of model_table as reported by plot.plot_model (see results.best_parameters): b0, a1, h1,
+    a2, h2, a3 and their errors, the slope of a line being a2; a third breakpoint adds h3 and a4.
+    """
+
+    params = dict.fromkeys(['b0', 'eb0', 'a1', 'ea1', 'h1', 'eh1', 'a2', 'ea2', 'h2', 'eh2', 'a3', 'ea3'], 0.0)
+    params['b0'], params['eb0'] = row['const'], row['const_se']
+    k = row['n_breakpoints']
+    slopes = ['a2'] if k == 0 else ['a{}'.format(j + 1) for j in range(k + 1)]
+    for key, value, error in zip(slopes, row['slopes'], row['slopes_se']):
+        params[key], params['e' + key] = value, error
+    for j in range(k):
+        params['h{}'.format(j + 1)], params['eh{}'.format(j + 1)] = row['breakpoints'][j], row['breakpoints_se'][j]
+    return params
+
+
+def figure_data(row, data):
+    """
+    The figure data of plot.figure_data (data) with the model, breakpoints and parameters of a model of model_table.
+    """
+
+    p = data['curve'][0]
+    return {**data, 'best_case': row['model'], 'curve': (p, predict(row, p)), 'breakpoints': list(row['breakpoints']),
+            'intervals': list(row['intervals']), 'params': best_parameters(row)}
@@ -0,0 +1,253 @@
+"""
+On-demand gradient fits over HTTP, on TCP or a Unix socket:
+
+    python service.py galaxies.csv flux_dir [--port 8080 | --unix /tmp/fits.sock] [--workers 4] [--engine native]
+
+    GET /fit/<galaxy>?calibrator=1&criterion=KA03       JSON row (parameters and status, as in batch.fit_survey)
+    GET /fit/<galaxy>.png?calibrator=1&criterion=KA03   PNG of the fit
+    GET /health                                         workers, jobs in flight and queue limit
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import pandas as pd
+
+import batch
+import fit_OH
+from abundance import CALIBRATORS
+
+## Asyncio job service around fit_OH.fit_final. Jobs run in a bounded process pool; identical jobs in flight share
+## one fit, and when max_pending jobs are queued new ones are refused with 503 (backpressure) instead of piling up.
+## Tables go to a sinks.NullSink and figures are drawn to PNG bytes in the workers with the Agg backend, so nothing
+## is written to tables/, tables_criterions/ or graphs/.
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+# --- Figure template of each worker process, created on its first PNG
+_template = None
+
+
+class Busy(Exception):
+    """
+    The queue of the service is full.
+    """
+
+
+def _png(figure):
+    global _template
+    if _template is None:
+        import render
+        _template = render.FigureTemplate()
+    _template.update(figure)
+    buffer = io.BytesIO()
+    _template.fig.savefig(buffer, format='png', transparent=False, facecolor='w', edgecolor='w')
+    return buffer.getvalue()
+
+
+def _run_job(params, flux_path, calibrator, criterion, fit_options, figure):
+    """
+    Worker: the summary row of one fit (see batch._fit_columns), with the PNG bytes under 'png' when figure is set.
+    """
+
+    row = batch._fit_columns(params, flux_path, calibrator, criterion, False, False, fit_options, 'none', None,
+                             keep_figure=figure)
+    if 'figure' in row:
+        row['png'] = _png(row.pop('figure'))
+    return row
+
+
+class FitService:
+    """
+    Fits the galaxies of galaxy_table (DataFrame or CSV) from flux_files (see batch.find_flux_files) on request,
+    over n_workers processes with at most max_pending jobs (default 4*n_workers) queued or running.
+    engine, n_boot, seed, cache and binning are passed to fit_OH.fit_final.
+    Use as an async context manager, or call start() and close().
+    """
+
+    def __init__(self, galaxy_table, flux_files, n_workers=1, max_pending=None,
+                 engine='piecewise_regression', n_boot=200, seed=None, cache=None, binning=None):
+        if not isinstance(galaxy_table, pd.DataFrame):
+            galaxy_table = pd.read_csv(galaxy_table)
+        self.galaxies = {str(params['galaxy']): params for params in galaxy_table.to_dict('records')}
+        self.files = batch.find_flux_files(flux_files)
+        self.n_workers = n_workers
+        self.max_pending = max_pending or 4 * n_workers
+        self.fit_options = {'engine': engine, 'n_boot': n_boot, 'seed': seed, 'cache': cache, 'binning': binning}
+        self.executor = None
+        self.in_flight = {}
+
+    def start(self):
+        # --- Workers are spawned, not forked from the process running the event loop
+        self.executor = ProcessPoolExecutor(max_workers=self.n_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    async def fit(self, galaxy, calibrator, criterion, figure=False):
+        """
+        The summary row of a fit. A request identical to one in flight (or a JSON request while the same fit is
+        being drawn) waits for that job instead of starting another. Raises KeyError for an unknown galaxy and Busy
+        when max_pending jobs are in flight.
+        """
+
+        future = self.in_flight.get((galaxy, calibrator, criterion, True))
+        if future is None and not figure:
+            future = self.in_flight.get((galaxy, calibrator, criterion, False))
+
+        if future is None:
+            if galaxy not in self.galaxies or galaxy not in self.files:
+                raise KeyError(galaxy)
+            if len(self.in_flight) >= self.max_pending:
+                raise Busy()
+            key = (galaxy, calibrator, criterion, figure)
+            future = asyncio.get_running_loop().run_in_executor(
+                self.executor, _run_job, self.galaxies[galaxy], self.files[galaxy], calibrator, criterion,
+                self.fit_options, figure)
+            self.in_flight[key] = future
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+
+        # --- A client that disconnects does not cancel a job other clients may be waiting for
+        return await asyncio.shield(future)
+
+    async def handle(self, reader, writer):
+        """
+        Serves one HTTP/1.1 request per connection (see the module docstring).
+        """
+
+        try:
+            status, content_type, body = await self._route(reader)
+        except Exception as error:
+            status, content_type, body = 500, 'application/json', json.dumps({'error': repr(error)}).encode()
+
+        head = 'HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n'.format(
+            status, STATUS_TEXT[status], content_type, len(body))
+        if status == 503:
+            head += 'Retry-After: 1\r\n'
+        try:
+            writer.write(head.encode('latin-1') + b'\r\n' + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _route(self, reader):
+        request = (await reader.readline()).decode('latin-1').split()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass  # headers are not used
+
+        def error(status, message):
+            return status, 'application/json', json.dumps({'error': message}).encode()
+
+        if len(request) < 2:
+            return error(400, 'malformed request')
+        method, target = request[0], urlsplit(request[1])
+        if method != 'GET':
+            return error(405, 'only GET is supported')
+
+        path = unquote(target.path)
+        if path == '/health':
+            return 200, 'application/json', json.dumps({'workers': self.n_workers, 'in_flight': len(self.in_flight),
+                                                        'max_pending': self.max_pending}).encode()
+        if not path.startswith('/fit/'):
+            return error(404, 'unknown path')
+
+        galaxy = path[len('/fit/'):]
+        figure = galaxy.endswith('.png')
+        if figure:
+            galaxy = galaxy[:-len('.png')]
+
+        query = parse_qs(target.query)
+        try:
+            calibrator = int(query.get('calibrator', ['1'])[0])
+        except ValueError:
+            return error(400, 'calibrator must be an integer')
+        criterion = query.get('criterion', ['none'])[0]
+        criterion = None if criterion.lower() == 'none' else criterion
+        if calibrator not in CALIBRATORS:
+            return error(400, 'calibrator must be one of {}'.format(sorted(CALIBRATORS)))
+        if criterion not in fit_OH.CRITERIONS:
+            return error(400, 'criterion must be one of {}'.format(fit_OH.CRITERIONS))
+
+        try:
+            row = await self.fit(galaxy, calibrator, criterion, figure)
+        except KeyError:
+            return error(404, 'unknown galaxy {}'.format(galaxy))
+        except Busy:
+            return error(503, 'too many jobs in flight, retry later')
+
+        if figure:
+            if 'png' not in row:
+                return error(500 if row['status'] == 'error' else 404, row['error'] or 'no figure: ' + row['status'])
+            return 200, 'image/png', row['png']
+        # --- The row may be shared with a PNG request for the same fit: serialise it without the image
+        row = {key: value for key, value in row.items() if key != 'png'}
+        return (500 if row['status'] == 'error' else 200), 'application/json', json.dumps(row).encode()
+
+
+async def serve(service, host='127.0.0.1', port=8080, unix_path=None):
+    """
+    Runs service (a FitService) on host:port, or on the Unix socket unix_path, until cancelled.
+    """
+
+    async with service:
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(service.handle, path=unix_path)
+        else:
+            server = await asyncio.start_server(service.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+async def request(target, host='127.0.0.1', port=8080, unix_path=None):
+    """
+    Minimal client: GET target (e.g. '/fit/NGC0309?calibrator=1&criterion=KA03'). Returns (status, body).
+    """
+
+    if unix_path is not None:
+        reader, writer = await asyncio.open_unix_connection(unix_path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    writer.write('GET {} HTTP/1.1\r\nHost: {}\r\nConnection: close\r\n\r\n'.format(target, host).encode('latin-1'))
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('galaxy_table')
+    parser.add_argument('flux_files')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix', default=None, help='Unix socket path (instead of host/port)')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--max-pending', type=int, default=None)
+    parser.add_argument('--engine', default='piecewise_regression')
+    parser.add_argument('--n-boot', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    service = FitService(args.galaxy_table, args.flux_files, n_workers=args.workers, max_pending=args.max_pending,
+                         engine=args.engine, n_boot=args.n_boot, seed=args.seed)
+    asyncio.run(serve(service, args.host, args.port, args.unix))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import os
+import queue
+import threading
+import uuid
+
+## Output sinks for the tables written by abundance.save_table ('abundance') and criteria.points ('criteria').
+## Writes are queued and done by a background thread, so the fitting never waits on the disk.
+
+
+class Sink:
+    """
+    Base class: write() queues a table, a background thread calls _write(). flush() waits for pending writes.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._errors = []
+
+    def write(self, kind, keys, table):
+        """
+        Queues a pandas.DataFrame. kind is 'abundance' or 'criteria'; keys is a dict with 'galaxy' and, for
+        criteria tables, 'calibrator' and 'criterion'. The table must not be modified afterwards.
+        """
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._queue.put((kind, keys, table))
+
+    def _run(self):
+        while True:
+            kind, keys, table = self._queue.get()
+            try:
+                self._write(kind, keys, table)
+            except Exception as error:
+                self._errors.append(error)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, kind, keys, table):
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Waits for the queued writes; raises the first error of a failed write.
+        """
+
+        self._queue.join()
+        if self._errors:
+            error = self._errors[0]
+            self._errors = []
+            raise error
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class NullSink(Sink):
+    """
+    Discards the tables (nothing is kept or written), for runs that only need the fits, e.g. the service.
+    """
+
+    def write(self, kind, keys, table):
+        pass
+
+
+class CSVSink(Sink):
+    """
+    The legacy layout: tables/<galaxy>.csv and tables_criterions/<galaxy>_<criterion>_<calibrator>.csv under root.
+    """
+
+    def __init__(self, root='.'):
+        super().__init__()
+        self.root = root
+
+    def _write(self, kind, keys, table):
+        if kind == 'abundance':
+            folder = os.path.join(self.root, 'tables')
+            file = str(keys['galaxy']) + '.csv'
+        else:
+            folder = os.path.join(self.root, 'tables_criterions')
+            file = str(keys['galaxy']) + '_' + str(keys['criterion']) + '_' + str(keys['calibrator']) + '.csv'
+        os.makedirs(folder, exist_ok=True)
+        table.to_csv(os.path.join(folder, file), index=False)
+
+
+class ParquetSink(Sink):
+    """
+    Appends every table to a Parquet dataset per kind (root/abundance, root/criteria), partitioned by galaxy and,
+    for criteria tables, calibrator and criterion. Requires pyarrow.
+    """
+
+    def __init__(self, root='tables_parquet'):
+        super().__init__()
+        import pyarrow  # noqa: F401 -- fail early when pyarrow is missing
+        self.root = root
+
+    def _write(self, kind, keys, table):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = table.assign(**{key: str(value) for key, value in keys.items()})
+        pq.write_to_dataset(pa.Table.from_pandas(table, preserve_index=False), os.path.join(self.root, kind),
+                            partition_cols=list(keys), basename_template=uuid.uuid4().hex + '-{i}.parquet')
+
+
+def make_sink(mode, root=None):
+    """
+    Sink from a mode name: 'none', 'csv' or 'parquet'. None keeps the legacy direct CSV writes.
+    """
+
+    if mode is None:
+        return None
+    elif mode == 'none':
+        return NullSink()
+    elif mode == 'csv':
+        return CSVSink(root or '.')
+    elif mode == 'parquet':
+        return ParquetSink(root or 'tables_parquet')
+    else:
+        raise ValueError("Invalid sink. Use 'none', 'csv' or 'parquet'.")
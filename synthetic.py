@@ -0,0 +1,151 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from abundance import AV
+from catalog import FLUX_COLUMNS
+
+## Synthetic galaxies with a known broken abundance gradient, in the format of data_NGC0309.csv and
+## HII.<name>.flux_elines.csv. Regions are placed at known normalized radii and the geometry of distance.distances is
+## inverted to get their RA/DEC; the line fluxes are built from the true OH by inverting the calibrators and
+## reddened with the extinction law of abundance, so the pipeline recovers the true OH (up to the noise).
+
+# --- Default true gradients for 0, 1 and 2 breakpoints: central OH, slopes of each segment and breakpoints (in Re)
+GRADIENTS = {0: dict(oh0=8.65, slopes=[-0.10], breakpoints=[]),
+             1: dict(oh0=8.55, slopes=[0.15, -0.25], breakpoints=[0.6]),
+             2: dict(oh0=8.50, slopes=[0.20, -0.30, 0.00], breakpoints=[0.5, 1.5])}
+
+# --- Intrinsic Halpha/Hbeta (case B, as in abundance) and SII6716/SII6730 ratio of the synthetic regions
+HA_HB = 2.86
+SII_RATIO = 1.4
+
+
+def true_oh(r, oh0, slopes, breakpoints):
+    """
+    Continuous piecewise-linear OH(r): oh0 at r = 0, slopes[j] between breakpoints[j-1] and breakpoints[j].
+    """
+
+    r = np.asarray(r, dtype=float)
+    oh = oh0 + slopes[0] * r
+    for breakpoint, before, after in zip(breakpoints, slopes[:-1], slopes[1:]):
+        oh = oh + (after - before) * np.maximum(r - breakpoint, 0)
+    return oh
+
+
+def positions(r, theta, ra0, dec0, pa, ba, d, re):
+    """
+    RA/DEC (degrees) of regions at normalized radius r and azimuth theta (radians) in the disk plane:
+    the inverse of distance.distances.
+    """
+
+    cos_i = np.sqrt((ba**2-0.13**2)/(1-0.13**2))
+    angle = r * re / (d * 1e3)  # radians
+    r1 = angle * np.cos(theta)
+    r2 = angle * np.sin(theta) * cos_i
+    sin_pa, cos_pa = np.sin(pa*np.pi/180), np.cos(pa*np.pi/180)
+    u = -sin_pa*r1 - cos_pa*r2  # (ra-ra0)*cos(dec)
+    v = cos_pa*r1 - sin_pa*r2  # dec-dec0
+    dec = dec0*np.pi/180 + v
+    ra = ra0*np.pi/180 + u/np.cos(dec)
+    return ra*180/np.pi, dec*180/np.pi
+
+
+def line_ratios(oh, calibrator=1):
+    """
+    Intrinsic log(line/Hbeta) of Halpha, [OIII], [NII] and [SII] giving abundance oh with the given calibrator.
+    The index a calibrator does not use comes from the PP04 calibrator of that index (both indices for D16).
+    """
+
+    oh = np.asarray(oh, dtype=float)
+    if calibrator in [1, 2, 5]:
+        o3n2, n2 = (8.73 - oh)/0.32, (oh - 8.90)/0.57
+    elif calibrator == 3:
+        o3n2, n2 = (8.533 - oh)/0.214, (oh - 8.90)/0.57
+    elif calibrator == 4:
+        o3n2, n2 = (8.73 - oh)/0.32, (oh - 8.743)/0.462
+    else:
+        raise ValueError("Invalid calibrator. Use 1=O3N2_PP04, 2=N2_PP04, 3=O3N2_M13, 4=N2_M13, 5=D16.")
+
+    log_ha = np.full_like(oh, np.log10(HA_HB))
+    log_nii = n2 + log_ha
+    log_oiii = o3n2 + n2
+    # --- D16: OH = 8.77 + log(NII/SII) + 0.264*N2
+    log_sii = log_nii - (oh - 8.77 - 0.264*n2)
+    log_sii6716 = log_sii + np.log10(SII_RATIO/(1 + SII_RATIO))
+    log_sii6730 = log_sii + np.log10(1/(1 + SII_RATIO))
+    return {'Ha6562': log_ha, 'OIII5006': log_oiii, 'NII6583': log_nii, 'SII6716': log_sii6716, 'SII6730': log_sii6730}
+
+
+def galaxy(name='SYN0001', n_regions=500, n_breakpoints=1, gradient=None, calibrator=1, noise=0.02, scatter=0.0,
+           nan_fraction=0.0, negative_fraction=0.0, r_max=2.5, seed=None):
+    """
+    One synthetic galaxy. gradient (dict of oh0, slopes, breakpoints) defaults to GRADIENTS[n_breakpoints].
+    noise is the relative flux error (fluxes are drawn around their true value with e_flux = noise*flux), scatter
+    an intrinsic OH scatter in dex, nan_fraction and negative_fraction the fractions of flux values replaced by NaN
+    or made negative. Returns (params, flux, truth): a row of the galaxy table (dict), the flux_elines table
+    (DataFrame with catalog.FLUX_COLUMNS) and the truth (gradient, calibrator, r and OH of every region).
+    """
+
+    rng = np.random.default_rng(seed)
+    gradient = dict(GRADIENTS[n_breakpoints] if gradient is None else gradient)
+
+    params = {'galaxy': name, 'ra0': rng.uniform(0, 360), 'dec0': rng.uniform(-60, 60),
+              'pa': rng.uniform(0, 180), 'ba': rng.uniform(0.3, 1.0), 're': rng.uniform(3, 15),
+              'dist': rng.uniform(20, 200)}
+
+    # --- Regions spread over the disk, denser towards the center as in the real catalogs
+    r = r_max * np.sqrt(rng.uniform(0, 1, n_regions))
+    theta = rng.uniform(0, 2*np.pi, n_regions)
+    ra, dec = positions(r, theta, params['ra0'], params['dec0'], params['pa'], params['ba'],
+                        params['dist'], params['re'])
+    oh = true_oh(r, **gradient) + scatter * rng.standard_normal(n_regions)
+
+    # --- Intrinsic ratios, reddened with a color excess per region: log(F/Hb)_obs = log(F/Hb) - 0.4 E (AV - AV_Hb)
+    excess = rng.uniform(0.0, 0.5, n_regions)
+    hb = 50 * rng.lognormal(0.0, 0.5, n_regions)
+    fluxes = {'Hb4861': hb}
+    for line, ratio in line_ratios(oh, calibrator).items():
+        fluxes[line] = hb * 10**(ratio - 0.4*excess*(AV[line] - AV['Hb4861']))
+
+    table = {'HIIREGID': ['{}-{}'.format(name, i + 1) for i in range(n_regions)], 'RA': ra, 'DEC': dec,
+             'EWHa6562': rng.uniform(5, 150, n_regions)}
+    for line in ['Hb4861', 'OIII5006', 'Ha6562', 'NII6583', 'SII6716', 'SII6730']:
+        error = noise * fluxes[line]
+        value = fluxes[line] + error * rng.standard_normal(n_regions)
+        value[rng.uniform(size=n_regions) < negative_fraction] *= -1
+        value[rng.uniform(size=n_regions) < nan_fraction] = np.nan
+        table['flux' + line] = value
+        table['e_flux' + line] = error
+
+    truth = dict(gradient, calibrator=calibrator, r=r, OH=oh)
+    return params, pd.DataFrame(table)[FLUX_COLUMNS], truth
+
+
+def survey(n_galaxies, n_regions=500, prefix='SYN', seed=None, **options):
+    """
+    n_galaxies synthetic galaxies (n_breakpoints cycling over 0, 1, 2 unless given). Returns the galaxy table,
+    the concatenated flux_elines catalog (see catalog.iter_galaxies) and the truths {name: truth}.
+    """
+
+    seeds = np.random.SeedSequence(seed).spawn(n_galaxies)
+    rows, tables, truths = [], [], {}
+    for i in range(n_galaxies):
+        name = '{}{:05d}'.format(prefix, i + 1)
+        galaxy_options = dict(options)
+        galaxy_options.setdefault('n_breakpoints', i % 3)
+        params, flux, truths[name] = galaxy(name, n_regions, seed=seeds[i], **galaxy_options)
+        rows.append(params)
+        tables.append(flux)
+    return pd.DataFrame(rows), pd.concat(tables, ignore_index=True), truths
+
+
+def write_survey(folder, galaxy_table, catalog):
+    """
+    Writes <folder>/galaxies.csv and one HII.<name>.flux_elines.csv per galaxy, the layout read by batch.fit_survey.
+    """
+
+    os.makedirs(folder, exist_ok=True)
+    galaxy_table.to_csv(os.path.join(folder, 'galaxies.csv'), index=False)
+    for name, flux in catalog.groupby(catalog['HIIREGID'].str.rsplit('-', n=1).str[0], sort=False):
+        flux.to_csv(os.path.join(folder, 'HII.{}.flux_elines.csv'.format(name)), index=False)
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+import binning
+import models
+
+
+def _points(n=600, seed=0):
+    """
+    A linear gradient with noise, and its errors.
+    """
+
+    rng = np.random.default_rng(seed)
+    r = np.sort(rng.uniform(0, 2, n))
+    eoh = rng.uniform(0.03, 0.1, n)
+    return r, 8.6 - 0.1*r + rng.normal(0, eoh), eoh
+
+
+def test_bins_are_weighted_means():
+    r, oh, eoh = _points()
+    rb, ohb, eohb, counts = binning.radial_bins(r, oh, eoh, n_bins=20)
+
+    assert len(rb) == 20 and counts.sum() == len(r)
+    edges = binning.bin_edges(r, 'count', 20)
+    first = r < edges[1]
+    w = 1/eoh[first]**2
+    assert rb[0] == pytest.approx(np.average(r[first], weights=w))
+    assert ohb[0] == pytest.approx(np.average(oh[first], weights=w))
+    assert eohb[0] == pytest.approx(1/np.sqrt(w.sum()))
+
+
+def test_points_without_a_usable_error_are_left_out():
+    r, oh, eoh = _points()
+    bad = eoh.copy()
+    bad[::7] = 0.0
+    bad[1::7] = -0.05
+    bad[2::7] = np.nan
+    good = np.isfinite(bad) & (bad > 0)
+
+    for errors in ('propagated', 'scatter'):
+        rb, ohb, eohb, counts = binning.radial_bins(r, oh, bad, n_bins=20, errors=errors)
+        expected = binning.radial_bins(r[good], oh[good], eoh[good], n_bins=20, errors=errors)
+
+        assert np.all(np.isfinite(rb)) and np.all(np.isfinite(ohb)) and np.all(np.isfinite(eohb))
+        assert counts.sum() == good.sum()
+        for value, reference in zip((rb, ohb, eohb, counts), expected):
+            np.testing.assert_array_equal(value, reference)
+
+
+def test_few_bins_are_rebinned_or_left_unbinned():
+    r, oh, eoh = _points(n=40)
+    rb, _, _, counts = binning.radial_bins(r, oh, eoh, mode='width', width=0.5)
+    assert len(rb) == models.MIN_POINTS and counts.sum() == len(r)
+
+    r, oh, eoh = _points(n=20)
+    rb, _, _, counts = binning.radial_bins(r, oh, eoh, mode='width', width=0.5)
+    np.testing.assert_array_equal(rb, r)
+    assert np.all(counts == 1)
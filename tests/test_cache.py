@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import batch
+import fit_OH
+import sinks
+from cache import FitCache
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _arrays(n=50, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(0, 2, n), rng.normal(8.5, 0.1, n), rng.uniform(0.05, 0.1, n)
+
+
+def test_key_changes_with_the_arrays_and_the_settings():
+    x, y, ey = _arrays()
+    key = FitCache.key(x, y, ey, engine='native', n_boot=100, seed=0)
+
+    assert FitCache.key(x.copy(), y.copy(), ey.copy(), seed=0, n_boot=100, engine='native') == key
+    y2 = y.copy()
+    y2[7] += 1e-9
+    assert FitCache.key(x, y2, ey, engine='native', n_boot=100, seed=0) != key
+    assert FitCache.key(x, y, ey[:-1], engine='native', n_boot=100, seed=0) != key
+    assert FitCache.key(x, y, ey, engine='native', n_boot=100, seed=1) != key
+    assert FitCache.key(x, y, ey, engine='grid', n_boot=100, seed=0) != key
+
+
+def test_calibrator_and_criterion_get_their_own_entries(tmp_path):
+    params = pd.read_csv(os.path.join(ROOT, 'data_NGC0309.csv')).to_dict('records')[0]
+    flux = pd.read_csv(os.path.join(ROOT, 'HII.NGC0309.flux_elines.csv'))
+    cache = FitCache(str(tmp_path / 'cache'))
+
+    def fit(calibrator, criterion):
+        output = fit_OH.fit_final(calibrator=calibrator, criterion=criterion, save_table=False, save_graph=False,
+                                  show_graph=False, engine='grid', cache=cache, sink=sinks.NullSink(),
+                                  **batch.galaxy_arguments(params, flux))
+        return output['result'], len(os.listdir(cache.path))
+
+    first, entries = fit(2, None)
+    assert entries == 1
+    again, entries = fit(2, None)
+    assert entries == 1
+    assert again.record.tobytes() == first.record.tobytes()
+
+    assert fit(4, None)[1] == 2
+    assert fit(2, 'KA03')[1] == 3
+
+
+def test_eviction_removes_the_least_recently_used_entries(tmp_path):
+    cache = FitCache(str(tmp_path / 'cache'), max_bytes=10**9)
+    for i in range(4):
+        cache.put('entry{}'.format(i), np.zeros(1000))
+        os.utime(cache._file('entry{}'.format(i)), (1000 + i, 1000 + i))
+    entry = os.path.getsize(cache._file('entry0'))
+    assert cache.size() == 4*entry
+
+    # --- entry0 is read, so entry1 becomes the least recently used
+    assert cache.get('entry0') is not None
+    cache.max_bytes = 3*entry
+    cache.put('entry4', np.zeros(1000))
+
+    assert sorted(name[:-4] for name in os.listdir(cache.path)) == ['entry0', 'entry3', 'entry4']
+    assert cache.size() <= cache.max_bytes
+
+    cache.max_bytes = entry
+    assert cache.evict() == entry
+    assert os.listdir(cache.path) == ['entry4.pkl']
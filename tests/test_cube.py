@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+import abundance
+import cube
+from catalog import FLUX_COLUMNS
+
+PARAMS = {'galaxy': 'CUBE01', 'ra0': 150.0, 'dec0': 2.0}
+
+
+def _cube(shape=(3, 5), seed=0):
+    """
+    A (planes, ny, nx) cube of positive fluxes with 10% errors, one spaxel of NaN Hbeta, one of negative Halpha (both
+    invalid) and one of NaN OIII (valid).
+    """
+
+    rng = np.random.default_rng(seed)
+    data = rng.uniform(1.0, 10.0, size=(len(cube.CUBE_PLANES),) + shape)
+    for column, plane in cube.CUBE_PLANES.items():
+        if column.startswith('e_'):
+            data[plane] = 0.1*data[cube.CUBE_PLANES[column[2:]]]
+    data[cube.CUBE_PLANES['fluxHb4861'], 0, 1] = np.nan
+    data[cube.CUBE_PLANES['fluxHa6562'], 2, 3] = -1.0
+    data[cube.CUBE_PLANES['fluxOIII5006'], 1, 0] = np.nan
+    return data
+
+
+def _check(columns, data):
+    assert list(columns) == FLUX_COLUMNS
+    nx = data.shape[2]
+    index = [int(name.rsplit('-', 1)[1]) for name in columns['HIIREGID']]
+    assert index == [i for i in range(data.shape[1] * nx) if i not in (1, 2*nx + 3)]
+    for column, plane in cube.CUBE_PLANES.items():
+        np.testing.assert_array_equal(columns[column], data[plane].reshape(-1)[index])
+
+
+def test_npy_cube_gives_the_valid_spaxels(tmp_path):
+    data = _cube()
+    path = str(tmp_path / 'flux_elines.CUBE01.cube.npy')
+    np.save(path, data)
+
+    assert cube.is_cube(path)
+    columns = cube.spaxel_columns(path, PARAMS)
+    _check(columns, data)
+
+    # --- The center spaxel (x=3, y=2, 1-based) is at the galaxy center
+    center = columns['HIIREGID'].tolist().index('CUBE01-7')
+    assert columns['RA'][center] == pytest.approx(PARAMS['ra0'])
+    assert columns['DEC'][center] == pytest.approx(PARAMS['dec0'])
+
+
+def test_fits_cube_columns_outlive_the_file(tmp_path):
+    fits = pytest.importorskip('astropy.io.fits')
+
+    data = _cube()
+    header = fits.Header({'CRVAL1': 10.0, 'CRVAL2': -5.0, 'CRPIX1': 1.0, 'CRPIX2': 1.0,
+                          'CDELT1': -1/3600, 'CDELT2': 1/3600})
+    path = str(tmp_path / 'flux_elines.CUBE01.cube.fits')
+    fits.PrimaryHDU(data, header).writeto(path)
+
+    columns = cube.spaxel_columns(path, PARAMS)
+    _check(columns, data)
+    assert columns['RA'][0] == pytest.approx(10.0)
+    assert columns['DEC'][0] == pytest.approx(-5.0)
+
+
+def test_nan_sii_plane_keeps_the_spaxels_for_the_other_calibrators():
+    data = _cube()
+    data[cube.CUBE_PLANES['fluxSII6716']] = np.nan
+    columns = cube.spaxel_columns(data, PARAMS)
+    _check(columns, data)
+
+    # --- D16 needs SII and fails everywhere; N2 holds for every spaxel, O3N2 for all but the one without OIII
+    out = abundance.abundance_kernel(columns)
+    assert not out['mask_D16'].any()
+    assert out['mask_PP04_N2'].all()
+    without_oiii = columns['HIIREGID'].tolist().index('CUBE01-5')
+    assert np.flatnonzero(~out['mask_PP04_O3N2']).tolist() == [without_oiii]
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import batch
+import breakpoints
+import fit_OH
+import models
+import results
+import selection
+import sinks
+import synthetic
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# --- Fixed synthetic galaxies (number of breakpoints, seed): a line and a gradient with one breakpoint at 0.6 re
+GALAXIES = [(0, 4), (1, 5)]
+
+
+@pytest.fixture(scope='module', params=GALAXIES, ids=['line', 'bp1'])
+def reference(request):
+    """
+    Points of a synthetic galaxy and their piecewise_regression fit.
+    """
+
+    n_breakpoints, seed = request.param
+    _, _, truth = synthetic.galaxy(n_regions=300, n_breakpoints=n_breakpoints, scatter=0.05, seed=seed)
+    r, oh, eoh = truth['r'], truth['OH'], np.full_like(truth['r'], 0.05)
+    return r, oh, eoh, n_breakpoints, models.fit_models(r, oh, eoh, n_boot=20, seed=1)
+
+
+@pytest.mark.parametrize('engine', ['native', 'grid'])
+def test_engine_matches_piecewise_regression(reference, engine):
+    r, oh, eoh, n_breakpoints, expected = reference
+    fit = models.fit_models(r, oh, eoh, engine=engine, n_boot=20, seed=1)
+
+    assert expected.best_case == n_breakpoints + 1
+    assert fit.best_case == expected.best_case
+    np.testing.assert_allclose(fit.breakpoints(fit.best_case), expected.breakpoints(expected.best_case), atol=1e-4)
+
+    params, expected_params = results.best_parameters(fit.record), results.best_parameters(expected.record)
+    for key, value in expected_params.items():
+        assert params[key] == pytest.approx(value, rel=1e-3, abs=1e-5), key
+
+
+@pytest.mark.parametrize('calibrator, criterion', [(2, None), (1, 'KA03')])
+def test_native_is_at_least_as_good_as_piecewise_regression_on_ngc0309(calibrator, criterion):
+    params = pd.read_csv(os.path.join(ROOT, 'data_NGC0309.csv')).to_dict('records')[0]
+    flux = pd.read_csv(os.path.join(ROOT, 'HII.NGC0309.flux_elines.csv'))
+
+    fits = {}
+    for engine in ('piecewise_regression', 'native'):
+        output = fit_OH.fit_final(calibrator=calibrator, criterion=criterion, save_table=False, save_graph=False,
+                                  show_graph=False, engine=engine, n_boot=100, seed=0, sink=sinks.NullSink(),
+                                  **batch.galaxy_arguments(params, flux))
+        fits[engine] = output['result']
+
+    expected, fit = fits['piecewise_regression'], fits['native']
+    assert fit.best_case == expected.best_case
+    for case in (2, 3):
+        if expected.record['converged{}'.format(case)]:
+            assert fit.record['converged{}'.format(case)]
+            assert fit.record['rss{}'.format(case)] <= expected.record['rss{}'.format(case)] * (1 + 1e-9)
+
+
+def test_dense_two_breakpoint_search_keeps_grid_size_candidates():
+    _, _, truth = synthetic.galaxy(n_regions=3000, n_breakpoints=2, scatter=0.05, seed=3)
+    r, oh = truth['r'], truth['OH']
+    fit = models.fit_models(r, oh, np.full_like(r, 0.05), engine='grid')
+
+    capped = breakpoints.GridBreakpointFit(r, oh, **models.FIT3, grid_size=selection.GRID_SIZE[2])
+    np.testing.assert_array_equal(fit.breakpoints(3), capped.breakpoints)
+    assert fit.record['rss3'] == pytest.approx(capped.rss)
@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+import batch
+import synthetic
+from manifest import Manifest
+
+
+@pytest.fixture
+def survey(tmp_path):
+    """
+    Three small synthetic galaxies written as flux_elines files, and the path of a run manifest.
+    """
+
+    galaxy_table, catalog, _ = synthetic.survey(3, n_regions=100, seed=1, scatter=0.05)
+    synthetic.write_survey(str(tmp_path), galaxy_table, catalog)
+    return str(tmp_path), str(tmp_path / 'manifest.sqlite')
+
+
+def run(folder, manifest, **options):
+    """
+    fit_survey of the survey in folder; returns the summary and the galaxies that were fitted (not reused).
+    """
+
+    options = dict(dict(n_workers=1, engine='grid', sink='none', profile=True), **options)
+    summary, records = batch.fit_survey(os.path.join(folder, 'galaxies.csv'), folder, 1, None,
+                                        manifest=manifest, **options)
+    return summary, sorted(record['galaxy'] for record in records)
+
+
+def test_rerun_skips_the_galaxies_that_are_done(survey):
+    folder, manifest = survey
+    first, fitted = run(folder, manifest)
+    assert fitted == ['SYN00001', 'SYN00002', 'SYN00003']
+
+    second, fitted = run(folder, manifest)
+    assert fitted == []
+    assert second[batch.PARAMS].equals(first[batch.PARAMS])
+    with Manifest(manifest) as checkpoints:
+        assert checkpoints.counts() == {'ok': 3}
+
+
+def test_changed_inputs_or_settings_are_refitted(survey):
+    folder, manifest = survey
+    run(folder, manifest)
+
+    # --- One flux file changes: only its galaxy is refitted
+    path = os.path.join(folder, 'HII.SYN00002.flux_elines.csv')
+    with open(path) as file:
+        lines = file.readlines()
+    with open(path, 'w') as file:
+        file.writelines(lines[:-1])
+    assert run(folder, manifest)[1] == ['SYN00002']
+
+    # --- Other fit settings or outputs: every galaxy is refitted
+    assert run(folder, manifest, engine='native', n_boot=10, seed=0)[1] == ['SYN00001', 'SYN00002', 'SYN00003']
+    assert run(folder, manifest, save_table=True)[1] == ['SYN00001', 'SYN00002', 'SYN00003']
+
+
+def test_failed_writes_are_not_checkpointed_and_are_retried(survey):
+    folder, manifest = survey
+    sink_root = os.path.join(folder, 'out')
+    open(sink_root, 'w').close()  # a file where the tables directory should be: every write fails
+
+    summary, _ = run(folder, manifest, save_table=True, sink='csv', sink_root=sink_root)
+    assert list(summary['status']) == ['error'] * 3
+    with Manifest(manifest) as checkpoints:
+        assert checkpoints.counts() == {'error': 3}
+
+    # --- Same fingerprint, writable outputs: the failed galaxies are fitted again
+    os.remove(sink_root)
+    summary, fitted = run(folder, manifest, save_table=True, sink='csv', sink_root=sink_root)
+    assert list(summary['status']) == ['ok'] * 3
+    assert fitted == ['SYN00001', 'SYN00002', 'SYN00003']
+    assert len(os.listdir(os.path.join(sink_root, 'tables_criterions'))) == 3
@@ -0,0 +1,30 @@
+import asyncio
+import json
+import os
+
+import service
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_concurrent_json_and_png_requests_share_one_fit():
+    async def run():
+        fits = service.FitService(os.path.join(ROOT, 'data_NGC0309.csv'), ROOT, n_workers=1, engine='grid')
+        async with fits:
+            server = await asyncio.start_server(fits.handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                target = '/fit/NGC0309{}?calibrator=1&criterion=KA03'
+                png = asyncio.ensure_future(service.request(target.format('.png'), port=port))
+                await asyncio.sleep(0.05)  # the PNG job is in flight when the JSON request arrives
+                answer = await service.request(target.format(''), port=port)
+                return await png, answer, len(fits.in_flight)
+
+    (png_status, png_body), (json_status, json_body), in_flight = asyncio.run(asyncio.wait_for(run(), 120))
+
+    assert png_status == 200 and png_body.startswith(b'\x89PNG')
+    assert json_status == 200
+    row = json.loads(json_body)
+    assert row['status'] == 'ok' and 'png' not in row
+    assert abs(row['h1'] - 0.654) < 1e-3
+    assert in_flight == 0
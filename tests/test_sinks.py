@@ -0,0 +1,72 @@
+import os
+
+import pandas as pd
+import pytest
+
+import batch
+import sinks
+import synthetic
+
+KEYS = {'galaxy': 'SYN00001', 'calibrator': 2, 'criterion': 'KA03'}
+
+
+def _table(n=5, offset=0):
+    return pd.DataFrame({'HIIREGID': ['R{}'.format(i) for i in range(offset, offset + n)],
+                         'r': [0.1*i for i in range(offset, offset + n)]})
+
+
+def test_parquet_round_trip(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+
+    with sinks.ParquetSink(str(tmp_path)) as sink:
+        sink.write('abundance', {'galaxy': 'SYN00001'}, _table())
+        sink.write('criteria', KEYS, _table())
+        sink.write('criteria', dict(KEYS, galaxy='SYN00002'), _table(3, offset=5))
+
+    table = pq.read_table(str(tmp_path / 'criteria')).to_pandas().sort_values('HIIREGID', ignore_index=True)
+    assert len(table) == 8
+    assert sorted(table['galaxy'].astype(str).unique()) == ['SYN00001', 'SYN00002']
+    assert set(table['calibrator'].astype(str)) == {'2'} and set(table['criterion'].astype(str)) == {'KA03'}
+    first = table[table['galaxy'].astype(str) == 'SYN00001'].reset_index(drop=True)
+    pd.testing.assert_frame_equal(first[['HIIREGID', 'r']], _table())
+    assert len(pq.read_table(str(tmp_path / 'abundance')).to_pandas()) == 5
+
+
+def test_flush_raises_a_failed_write_once(tmp_path):
+    root = str(tmp_path / 'out')
+    open(root, 'w').close()  # a file where the tables directory should be
+
+    sink = sinks.CSVSink(root)
+    sink.write('abundance', {'galaxy': 'SYN00001'}, _table())
+    with pytest.raises(OSError):
+        sink.flush()
+    sink.flush()  # the error is reported once
+
+    os.remove(root)
+    sink.write('criteria', KEYS, _table())
+    sink.close()
+    assert os.listdir(os.path.join(root, 'tables_criterions')) == ['SYN00001_KA03_2.csv']
+
+
+def test_null_sink_discards_the_tables():
+    with sinks.NullSink() as sink:
+        sink.write('abundance', {'galaxy': 'SYN00001'}, _table())
+        assert sink._thread is None
+
+
+def test_tables_are_written_before_the_row_is_returned(tmp_path):
+    galaxy_table, catalog, _ = synthetic.survey(1, n_regions=100, seed=1, scatter=0.05)
+    params, flux = galaxy_table.to_dict('records')[0], catalog
+    root = str(tmp_path / 'out')
+    options = {'engine': 'grid', 'n_boot': 10, 'seed': 0, 'cache': None, 'binning': None}
+
+    row = batch._fit_columns(params, flux, 2, None, True, False, options, 'csv', root)
+    assert row['status'] == 'ok'
+    table = pd.read_csv(os.path.join(root, 'tables', params['galaxy'] + '.csv'))
+    assert len(table) == len(flux)
+
+    # --- A write that fails makes the row an error, with the write error as its message
+    blocked = str(tmp_path / 'blocked')
+    open(blocked, 'w').close()
+    row = batch._fit_columns(params, flux, 2, None, True, False, options, 'csv', blocked)
+    assert row['status'] == 'error' and 'NotADirectoryError' in row['error']